@@ -1,4 +1,8 @@
+import io
+import mmap
 import struct
+import sys
+import time
 
 BYTE = "B"
 WORD = "H"
@@ -10,9 +14,15 @@ DISKINFO = [
 	("tracks", BYTE),		# 0x30
 	("sides", BYTE),		# 0x31
 	("tracklen", WORD),		# 0x32-0x33
-	("unused2", BYTE * 0xCC)	# 0x34-0xFF
+	("tracksizes", BYTE * 0xCC)	# 0x34-0xFF, extended DSK: track length / 0x100
 	]
 
+EXTENDED_MAGIC = "EXTENDED"
+
+# AMSDOS block and record sizes
+BLOCK_SIZE = 1024
+RECORD_SIZE = 128
+
 SECTORINFO = [
 	("track", BYTE),
 	("side", BYTE),
@@ -82,32 +92,256 @@ def quotechars(chars):
 	return ''.join( ['.', c][c.isalnum()] for c in chars )
 
 
-def extract_str(str, file, endianness):
-    	struct_str = endianness + str
-    	unpack = struct.unpack(struct_str, file.read(struct.calcsize(struct_str)))
-    	if len(unpack) == 1:
-        	i, = unpack
-        	return i
-    	return list(unpack)
+class DescriptionError(Exception):
+	pass
+
+class Record(object):
+	"""
+	Decoded descriptor, its fields being read as attributes or as
+	record['field'].
+	"""
+	__slots__ = ()
+
+	def __getitem__(self, field):
+		return getattr(self, field)
+
+	def __repr__(self):
+		return "%s(%s)" % (self.__class__.__name__,
+			", ".join("%s=%r" % (field, getattr(self, field)) for field in self.__slots__))
+
+class Descriptor(object):
+	"""
+	Descriptor compiled once into a single struct.Struct, with the range
+	of unpacked values of every field: a record is decoded with one
+	unpack_from. Fields of one value are scalars, the others lists.
+	"""
+	def __init__(self, descr, endianness="<", name="Record"):
+		self.fields = []
+		fmt = ""
+		index = 0
+		for field, value in descr:
+			if isinstance(value, basestring):
+				count = len(struct.unpack(endianness + value, b"\0" * struct.calcsize(endianness + value)))
+				self.fields.append((field, index, count, None))
+				fmt += value
+			elif isinstance(value, list):
+				sub = Descriptor(value, endianness, field)
+				self.fields.append((field, index, len(sub.struct.unpack(b"\0" * sub.size)), sub))
+				fmt += sub.struct.format.lstrip("<>=!@")
+				count = self.fields[-1][2]
+			else:
+				raise DescriptionError("Unhandled type for field : " + field)
+			index += count
+		self.struct = struct.Struct(endianness + fmt)
+		self.size = self.struct.size
+		self.record = type(name, (Record,), {"__slots__": tuple(field for field, value in descr)})
+
+	def decode(self, values, index=0):
+		record = self.record()
+		for field, start, count, sub in self.fields:
+			start += index
+			if sub is not None:
+				value = sub.decode(values, start)
+			elif count == 1:
+				value = values[start]
+			else:
+				value = list(values[start:start + count])
+			setattr(record, field, value)
+		return record
+
+	def unpack_from(self, data, offset=0):
+		return self.decode(self.struct.unpack_from(data, offset))
+
+	def read(self, file):
+		return self.decode(self.struct.unpack(file.read(self.size)))
+
+# descriptors compiled by depack(), by (id, endianness)
+DESCRIPTORS = dict()
+
+def descriptor(descr, endianness = "<"):
+	key = (id(descr), endianness)
+	if key not in DESCRIPTORS:
+		DESCRIPTORS[key] = Descriptor(descr, endianness)
+	return DESCRIPTORS[key]
 
 def depack(descr, file, endiannes = "<"):
-    	struct = dict()
-    	for field, value in iter(descr):
-        	if isinstance(value, basestring):
-            		struct.update({field : extract_str(value, file, endiannes)})
-            		continue
-        	if isinstance(value, list):
-            		struct.update({field : depack(value, file, endiannes)})
-            		continue
-        	raise DescriptionError("Unhandled type for field : " + field)
-    	return struct
+	return descriptor(descr, endiannes).read(file)
+
+class BlockView(object):
+	"""
+	Block spanning two sectors, kept as the two slices of the image; the
+	bytes are only joined when sliced or converted.
+	"""
+	__slots__ = ("parts",)
+
+	def __init__(self, *parts):
+		self.parts = parts
+
+	def __len__(self):
+		return sum(len(part) for part in self.parts)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return self.tobytes()[i]
+		if i < 0:
+			i += len(self)
+		for part in self.parts:
+			if i < len(part):
+				return part[i]
+			i -= len(part)
+		raise IndexError("block index out of range")
+
+	def tobytes(self):
+		return b"".join(bytes(part) for part in self.parts)
+
+	__str__ = tobytes
+
+class AmsdosFile(io.RawIOBase):
+	"""
+	Read-only file of a disk, streamed block by block from its ordered
+	block list. An AMSDOS header with a right checksum is stripped, and
+	gives the file length; without one, the file is its whole records.
+	"""
+	def __init__(self, dskr, name, blocks, records):
+		io.RawIOBase.__init__(self)
+		self.dskr = dskr
+		self.name = name
+		self.blocks = blocks
+		self.header = None
+		self.start = 0
+		self.length = min(records * RECORD_SIZE, len(blocks) * BLOCK_SIZE)
+		self.pos = 0
+		if self.length >= RECORD_SIZE:
+			data = bytes(dskr.readbloc(blocks[0])[0:RECORD_SIZE])
+			header = descriptor(STAMSDOS).unpack_from(data)
+			if sum(bytearray(data[:67])) & 0xFFFF == header['checksum']:
+				self.header = header
+				self.start = RECORD_SIZE
+				self.length = min(header['reallength'] | header['biglength'] << 16, self.length - RECORD_SIZE)
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self.pos
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self.pos
+		elif whence == io.SEEK_END:
+			offset += self.length
+		if offset < 0:
+			raise ValueError("negative seek position %d" % offset)
+		self.pos = offset
+		return self.pos
+
+	def readinto(self, b):
+		# at most the rest of the current block
+		size = min(len(b), self.length - self.pos)
+		if size <= 0:
+			return 0
+		index, offset = divmod(self.start + self.pos, BLOCK_SIZE)
+		size = min(size, BLOCK_SIZE - offset)
+		b[:size] = bytes(self.dskr.readbloc(self.blocks[index])[offset:offset + size])
+		self.pos += size
+		return size
 
 class DskReader():
 
-	def __init__(self, filename):
+	def __init__(self, filename, usemmap=False):
+		# with usemmap, the image is mapped: headers are read from the
+		# mapping and sectors are returned as slices of it, without copy
 		self.filename = filename
 		self.file = open(filename, "rb")
+		self.map = None
+		self.view = None
+		if usemmap:
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				self.view = memoryview(self.map)
+			except TypeError:
+				# py2 mmap only has the old buffer interface
+				self.view = None
+			self.file.close()
+			self.file = self.map
 		self.diskinfo = None
+		self.buildindex()
+
+	def close(self):
+		self.view = None
+		self.file.close()
+
+	def getdata(self, pos, size):
+		# size bytes at pos: a slice of the mapping, or a copy read from
+		# the file
+		if self.view is not None:
+			return self.view[pos:pos + size]
+		if self.map is not None:
+			return buffer(self.map, pos, size)
+		self.file.seek(pos, 0)
+		return self.file.read(size)
+
+	def buildindex(self):
+		# walk the track and sector headers once, so lookups are dict hits:
+		# sectorindex[(track, side, sectorID)] and physindex[(track entry,
+		# sector number)] give the offset of the sector data, and
+		# sectorsizes its size and number of copies
+		self.sectorindex = dict()
+		self.physindex = dict()
+		self.tracksides = []
+		self.trackends = []
+		# sector data offset: (size, copies)
+		self.sectorsizes = dict()
+		trackinfo = descriptor(TRACKINFO)
+		sectorinfo = descriptor(SECTORINFO)
+		diskinfo = descriptor(DISKINFO).unpack_from(self.getdata(0, 0x100))
+		self.extended = ''.join(map(chr, diskinfo['magic'])).startswith(EXTENDED_MAGIC)
+		ntracks = diskinfo['tracks'] * max(diskinfo['sides'], 1)
+		# track offsets, in one pass: extended images give the length of
+		# every track, 0 for an unformatted one, standard ones a single length
+		if self.extended:
+			lengths = [size << 8 for size in diskinfo['tracksizes'][:ntracks]]
+		else:
+			lengths = [diskinfo['tracklen']] * ntracks
+		TrackPos = 0x100
+		for i in xrange(0, ntracks):
+			if lengths[i] == 0:
+				self.tracksides.append(None)
+				self.trackends.append(TrackPos)
+				continue
+			# one read per track header, decoded in place
+			header = self.getdata(TrackPos, 0x100)
+			try:
+				track = trackinfo.unpack_from(header)
+				sectors = [sectorinfo.unpack_from(header, trackinfo.size + j * sectorinfo.size)
+					for j in xrange(0, track['numberofsectors'])]
+			except struct.error:
+				# truncated image
+				break
+			Pos = TrackPos + 0x100
+			side = (track['tracknumber'], track['sidenumber'])
+			self.tracksides.append(side)
+			for j, sector in enumerate(sectors):
+				self.physindex[(i, j)] = Pos
+				# the first of duplicated IDs wins, as a sequential search would
+				self.sectorindex.setdefault(side + (sector['sectorID'],), Pos)
+				size = 128 << min(sector['size'], 8)
+				stored = size
+				if sector['SectSize'] != 0:
+					# extended: stored length, several copies of weak sectors
+					stored = sector['SectSize']
+				self.sectorsizes[Pos] = (min(size, stored), max(stored // size, 1))
+				Pos += stored
+			self.trackends.append(Pos)
+			TrackPos += lengths[i] or (Pos - TrackPos)
+		self.minsect = 0x100
+		if self.tracksides:
+			for track, side, sectorID in self.sectorindex:
+				if (track, side) == self.tracksides[0] and sectorID < self.minsect:
+					self.minsect = sectorID
 
 	def byte(self, val):
 		return struct.pack("<B", val)[0]
@@ -150,25 +384,68 @@ class DskReader():
 			self.getinfodirectory(i)
 
 	def getposdata(self, tk, sect, physik):
-		Pos = 0x100
-		for i in xrange(0, tk + 1):
-			self.file.seek(Pos, 0)
-			track = depack(TRACKINFO, self.file)
-			Pos += 0x100
-			for j in xrange(0, track['numberofsectors']):
-				sector = depack(SECTORINFO, self.file)
-				if i == tk:
-					if ((sector['sectorID'] == sect) and physik == 1) or ((j == sect) and physik == 0):
-						break
-				if sector['SectSize'] != 0:
-					Pos += sector['SectSize']
-				else:
-					Pos += (128 << sector['size'])
+		# tk is a track entry of the image; a missing sector gives the end
+		# of the track
+		if physik == 1:
+			side = self.tracksides[tk]
+			Pos = self.sectorindex.get(side + (sect,)) if side is not None else None
+		else:
+			Pos = self.physindex.get((tk, sect))
+		if Pos is None:
+			return self.trackends[tk]
 		return Pos
 
+	def getdirectory(self, numdir):
+		pos = ((numdir & 15) << 5) + self.getposdata(0, (numdir >> 4) + self.getminsect(), 1)
+		return descriptor(DIRENTRY).unpack_from(self.getdata(pos, 32))
+
+	def listdirectory(self):
+		# (name, entry) of the first extent of every file
+		files = []
+		for numdir in xrange(0, 64):
+			directory = self.getdirectory(numdir)
+			name = ''.join(map(chr, directory['name']))
+			if directory['numpage'] != 0 or self.namevalid(name) == False:
+				continue
+			files.append((self.Nameamsdos(name, ''.join(map(chr, directory['ext']))), directory))
+		return files
+
+	def readsector(self, tk, sect, physik=1, copy=0):
+		# data of a sector, copy choosing among the copies of a weak one
+		Pos = self.getposdata(tk, sect, physik)
+		if Pos not in self.sectorsizes:
+			return None
+		size, copies = self.sectorsizes[Pos]
+		return self.getdata(Pos + (copy % copies) * size, size)
+
+	def getextents(self, name, user=None):
+		# directory extents of a file, by extent number; the attribute bits
+		# of the name are ignored
+		extents = []
+		for numdir in xrange(0, 64):
+			directory = self.getdirectory(numdir)
+			if directory['user'] == 0xE5 or (user is not None and directory['user'] != user):
+				continue
+			entryname = self.Nameamsdos(''.join(chr(c & 0x7F) for c in directory['name']),
+				''.join(chr(c & 0x7F) for c in directory['ext']))
+			if entryname.upper() == name.upper():
+				if user is None:
+					user = directory['user']
+				extents.append(directory)
+		extents.sort(key=lambda directory: directory['numpage'])
+		return extents
+
+	def open_file(self, name, user=None):
+		# seekable read-only stream of a file, the blocks being read as needed
+		extents = self.getextents(name, user)
+		if not extents:
+			raise IOError("%s: no such file on %s" % (name, self.filename))
+		blocks = [bloc for directory in extents for bloc in directory['blocks'] if bloc != 0]
+		records = extents[-1]['numpage'] * 128 + extents[-1]['nbpages']
+		return AmsdosFile(self, name, blocks, records)
+
 	def getinfodirectory(self, numdir):
-		self.file.seek(((numdir & 15) << 5) + self.getposdata(0, (numdir >> 4) + self.getminsect(), 1), 0)
-		directory = depack(DIRENTRY, self.file)
+		directory = self.getdirectory(numdir)
 		#if directory['user'] == 0xE5:		# USER_DELETED
 		#	return
 		if directory['numpage'] != 0:
@@ -193,30 +470,24 @@ class DskReader():
 		return True
 	
 	def getminsect(self):
-		self.file.seek(0x100, 0)
-		sect = 0x100
-		track = depack(TRACKINFO, self.file)
-		for i in xrange(0, track['numberofsectors']):
-			sector = depack(SECTORINFO, self.file)
-			if (sect > sector['sectorID']):
-				sect = sector['sectorID']
-		return sect
+		return self.minsect
 
 	def readbloc(self, bloc):
 		track = (bloc << 1) / 9
 		sect = (bloc << 1) % 9
 		minsect = self.getminsect()
 		pos = self.getposdata(track, sect + minsect, 1)
-		self.file.seek(pos, 0)
-		bloc = self.file.read(512)
 		sect += 1
 		if sect > 8:
 			track += 1
 			sect = 0
-		pos = self.getposdata(track, sect + minsect, 1)
-		self.file.seek(pos, 0)
-		bloc += self.file.read(512)
-		return bloc
+		pos2 = self.getposdata(track, sect + minsect, 1)
+		if self.map is None:
+			return self.getdata(pos, 512) + self.getdata(pos2, 512)
+		if pos2 == pos + 512:
+			# sectors stored next to each other
+			return self.getdata(pos, 1024)
+		return BlockView(self.getdata(pos, 512), self.getdata(pos2, 512))
 
 	def Nameamsdos(self, name, ext):
 		res = ""
@@ -228,8 +499,24 @@ class DskReader():
 			res += ext[i]
 		return res
 
+def bench(filename, usemmap=False, repeat=200):
+	# directory listings per second, each opening and indexing the image
+	start = time.time()
+	for i in xrange(0, repeat):
+		dskr = DskReader(filename, usemmap)
+		files = dskr.listdirectory()
+		dskr.close()
+	elapsed = time.time() - start
+	print("%d files, %d listings in %.3fs, %.0f listings/s" % (len(files), repeat, elapsed, repeat / elapsed))
+
 def main():
-	dskr = DskReader("Lode_Runner.dsk")
+	# usage: python dsk_reader.py [-b] [-m] [image.dsk]
+	args = sys.argv[1:]
+	filenames = [arg for arg in args if not arg.startswith("-")] or ["Lode_Runner.dsk"]
+	if "-b" in args:
+		bench(filenames[0], "-m" in args)
+		return
+	dskr = DskReader(filenames[0], "-m" in args)
 	dskr.getdiskinfo()
 	dskr.printdiskinfo()
 	dskr.printtrackinfo()
@@ -0,0 +1,193 @@
+"""
+Register map compiler.
+
+Every <platform>.txt spec of this directory (gbatek layout: address,
+size, access, mnemonic, description) is compiled into a <platform>.iotab
+binary table holding sorted (address, size, name, comment) records. A
+table is only rebuilt when its spec changed since it was compiled.
+
+usage: python gen_io_naming.py [-f] [platform ...]
+"""
+
+import os
+import re
+import struct
+import sys
+
+PLATFORMS = ["gb", "cgb", "nes", "gba", "snes"]
+SPEC_EXT = ".txt"
+TABLE_EXT = ".iotab"
+TABLE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+TABLE_MAGIC = b"IOT1"
+# magic, spec mtime, record count
+TABLE_HEADER = struct.Struct("<4sdI")
+# address, size, name length, comment length; strings follow the record
+TABLE_RECORD = struct.Struct("<IHBH")
+
+# address, size, access, mnemonic, description
+LINE = re.compile(r"^([0-9A-Fa-f]+)h\s+(\S+)\s+(\S+)\s+(\S+)\s+(.*?)\s*$")
+# array size, as in "2x10h"
+ARRAY_SIZE = re.compile(r"^\d+x([0-9A-Fa-f]+)h$")
+
+def _bytes(s):
+	if isinstance(s, bytes):
+		return s
+	return s.encode("latin-1")
+
+def _str(b):
+	if str is bytes:
+		return b
+	return b.decode("latin-1")
+
+def spec_path(platform):
+	return os.path.join(TABLE_DIR, platform + SPEC_EXT)
+
+def table_path(platform):
+	return os.path.join(TABLE_DIR, platform + TABLE_EXT)
+
+def register_size(size):
+	# size in bytes, 0 when unknown
+	if size.isdigit():
+		return int(size)
+	m = ARRAY_SIZE.match(size)
+	if m:
+		return int(m.group(1), 16)
+	return 0
+
+def register_name(mnemonic, description):
+	# undocumented registers have no mnemonic, fall back on the description
+	if mnemonic not in ("-", "?"):
+		return mnemonic
+	return re.sub("[^0-9A-Za-z_]", "", description.replace(" - ", "_").replace(" ", ""))
+
+def parse_spec(path):
+	"""
+	(address, size, name, comment) of every register of a spec file, in
+	file order. Unused ranges are skipped.
+	"""
+	registers = []
+	f = open(path, 'r')
+	for line in f.readlines():
+		if line.rstrip().endswith("Not used"):
+			continue
+		m = LINE.match(line)
+		if not m:
+			continue
+		addr, size, access, mnemonic, description = m.groups()
+		description = re.sub(r"\s+", " ", description)
+		registers.append((int(addr, 16), register_size(size), register_name(mnemonic, description),
+			"%s %s" % (access, description)))
+	f.close()
+	return registers
+
+def check_overlaps(registers):
+	"""
+	Sort registers by address, merging the ones sharing an address into
+	the first one's comment, and clipping the size of a register running
+	into the next one. Returns (records, warnings).
+	"""
+	records = []
+	warnings = []
+	# the sort is stable, so the first register of an address stays first
+	for addr, size, name, comment in sorted(registers, key=lambda r: r[0]):
+		if records and records[-1][0] == addr:
+			prev_addr, prev_size, prev_name, prev_comment = records[-1]
+			warnings.append("duplicate address 0x%08X: %s / %s" % (addr, prev_name, name))
+			records[-1] = (addr, prev_size, prev_name, "%s / %s: %s" % (prev_comment, name, comment))
+			continue
+		if records and records[-1][0] + records[-1][1] > addr:
+			prev_addr, prev_size, prev_name, prev_comment = records[-1]
+			warnings.append("overlap at 0x%08X: %s (0x%08X, %d bytes) / %s" % (addr, prev_name, prev_addr, prev_size, name))
+			records[-1] = (prev_addr, addr - prev_addr, prev_name, prev_comment)
+		records.append((addr, size, name, comment))
+	return records, warnings
+
+def pack_table(records, mtime):
+	chunks = [TABLE_HEADER.pack(TABLE_MAGIC, mtime, len(records))]
+	for addr, size, name, comment in records:
+		name = _bytes(name)[:0xFF]
+		comment = _bytes(comment)[:0xFFFF]
+		chunks.append(TABLE_RECORD.pack(addr, size, len(name), len(comment)))
+		chunks.append(name)
+		chunks.append(comment)
+	return b"".join(chunks)
+
+def unpack_table(data):
+	"""
+	Returns (spec mtime, records) of a packed table, or (None, None) if
+	data is not a table.
+	"""
+	if len(data) < TABLE_HEADER.size:
+		return None, None
+	magic, mtime, count = TABLE_HEADER.unpack_from(data, 0)
+	if magic != TABLE_MAGIC:
+		return None, None
+	records = []
+	offset = TABLE_HEADER.size
+	try:
+		for i in range(count):
+			addr, size, name_len, comment_len = TABLE_RECORD.unpack_from(data, offset)
+			offset += TABLE_RECORD.size
+			name = _str(data[offset:offset + name_len])
+			offset += name_len
+			comment = _str(data[offset:offset + comment_len])
+			offset += comment_len
+			records.append((addr, size, name, comment))
+	except struct.error:
+		return None, None
+	return mtime, records
+
+def read_table(platform):
+	try:
+		f = open(table_path(platform), 'rb')
+	except (IOError, OSError):
+		return None, None
+	try:
+		return unpack_table(f.read())
+	finally:
+		f.close()
+
+def compile_table(platform):
+	"""
+	Compile and write the table of platform. Returns (records, warnings).
+	"""
+	mtime = os.path.getmtime(spec_path(platform))
+	records, warnings = check_overlaps(parse_spec(spec_path(platform)))
+	try:
+		f = open(table_path(platform), 'wb')
+		try:
+			f.write(pack_table(records, mtime))
+		finally:
+			f.close()
+	except (IOError, OSError):
+		# read-only install, keep the compiled table in memory only
+		pass
+	return records, warnings
+
+def load_table(platform):
+	"""
+	Register records of platform, recompiled first if the spec changed.
+	"""
+	mtime, records = read_table(platform)
+	if records is None or mtime != os.path.getmtime(spec_path(platform)):
+		records = compile_table(platform)[0]
+	return records
+
+def main():
+	args = sys.argv[1:]
+	force = "-f" in args
+	platforms = [arg for arg in args if arg != "-f"] or PLATFORMS
+	for platform in platforms:
+		mtime, records = read_table(platform)
+		if not force and records is not None and mtime == os.path.getmtime(spec_path(platform)):
+			print("[=] %s: %d registers, up to date" % (platform, len(records)))
+			continue
+		records, warnings = compile_table(platform)
+		print("[+] %s: %d registers" % (platform, len(records)))
+		for warning in warnings:
+			print("    warning: %s" % warning)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,24 @@
+import idc
+
+from gen_io_naming import load_table
+
+def apply_names(platform, base=0):
+	"""
+	Name, type and comment every register of a platform table, in a
+	single pass. Returns the number of registers.
+	"""
+	records = load_table(platform)
+	for addr, size, name, comment in records:
+		ea = base + addr
+		idc.MakeNameEx(ea, name, idc.SN_NOCHECK | idc.SN_NOWARN)
+		if size == 1:
+			idc.MakeByte(ea)
+		elif size == 2:
+			idc.MakeWord(ea)
+		elif size == 4:
+			idc.MakeDword(ea)
+		elif size > 0:
+			idc.MakeByte(ea)
+			idc.MakeArray(ea, size)
+		idc.MakeComm(ea, comment)
+	return len(records)
@@ -1,6 +1,13 @@
 import idc 
 import idaapi
+import os
 import struct
+import sys
+
+LOADER_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(LOADER_DIR)
+sys.path.append(os.path.join(LOADER_DIR, "..", "IO_registers"))
+from io_naming import apply_names
 
 ROM_SIGNATURE_OFFSET 	= 0x104
 ROM_SIGNATURE        	= "\xCE\xED\x66\x66\xCC\x0D\x00\x0B\x03\x73\x00\x83\x00\x0C\x00\x0D"
@@ -9,6 +16,7 @@ ROM_SIGNATURE		+= "\xBB\xBB\x67\x63\x6E\x0E\xEC\xCC\xDD\xDC\x99\x9F\xBB\xB9\x33\
 ROM_SIGNATURE_LENGTH	= 0x30
 ROM_FORMAT_NAME        	= "Nintendo GB ROM"
 SIZE_HEADER		= 0x150
+CGB_FLAG_OFFSET		= 0x143
 ROM0_START		= 0
 ROM0_SIZE		= 0x4000
 ROM1_START		= 0x4000
@@ -103,7 +111,7 @@ def load_file(li, neflags, format):
 	idc.RenameSeg(HRAM_START, "HRAM")
 
 	header_info(li)
-	naming()
+	naming(li)
 	print("[+] Load OK")
 	return 1
 
@@ -128,118 +136,12 @@ def header_info(li):
 	idc.ExtLinA(0, 15,  "; Global Checksum : %02X" % struct.unpack("<B", li.read(1))[0])
 	idc.ExtLinA(0, 16,  "-------------------------------")
 
-def naming():
-	MakeNameEx(0xFF40, "LCD_Control", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF40)
-	MakeNameEx(0xFF41, "LCD_Status", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF41)
-	MakeNameEx(0xFF42, "SCY", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF42)
-	MakeNameEx(0xFF43, "SCX", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF43)
-	MakeNameEx(0xFF44, "LY", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF44)
-	MakeNameEx(0xFF45, "LYC", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF45)
-	MakeNameEx(0xFF4A, "WY", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF4A)
-	MakeNameEx(0xFF4B, "WX", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF4B)
-	MakeNameEx(0xFF47, "BGP", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF47)	
-	MakeNameEx(0xFF48, "OBP0", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF48)
-	MakeNameEx(0xFF49, "OBP1", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF49)
-	MakeNameEx(0xFF68, "BCPS", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF68)
-	MakeNameEx(0xFF69, "BCPD", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF69)
-	MakeNameEx(0xFF6A, "OCPS", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF6A)
-	MakeNameEx(0xFF6B, "OCPD", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF6B)
-	MakeNameEx(0xFF4F, "VBK", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF4F)
-	MakeNameEx(0xFF46, "DMA", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF46)
-	MakeNameEx(0xFF51, "HDMA1", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF51)
-	MakeNameEx(0xFF52, "HDMA2", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF52)
-	MakeNameEx(0xFF53, "HDMA3", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF53)
-	MakeNameEx(0xFF54, "HDMA4", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF54)
-	MakeNameEx(0xFF55, "HDMA5", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF55)
-	MakeNameEx(0xFF10, "NR10", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF10)
-	MakeNameEx(0xFF11, "NR11", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF11)
-	MakeNameEx(0xFF12, "NR12", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF12)
-	MakeNameEx(0xFF13, "NR13", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF13)
-	MakeNameEx(0xFF14, "NR14", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF14)
-	MakeNameEx(0xFF16, "NR21", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF16)
-	MakeNameEx(0xFF17, "NR22", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF17)
-	MakeNameEx(0xFF18, "NR23", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF18)
-	MakeNameEx(0xFF19, "NR24", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF19)
-	MakeNameEx(0xFF1A, "NR30", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF1A)
-	MakeNameEx(0xFF1B, "NR31", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF1B)
-	MakeNameEx(0xFF1C, "NR32", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF1C)
-	MakeNameEx(0xFF1D, "NR33", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF1D)
-	MakeNameEx(0xFF1E, "NR34", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF1E)
-	MakeNameEx(0xFF20, "NR41", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF20)
-	MakeNameEx(0xFF21, "NR42", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF21)
-	MakeNameEx(0xFF22, "NR43", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF22)
-	MakeNameEx(0xFF23, "NR44", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF23)
-	MakeNameEx(0xFF24, "NR50", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF24)
-	MakeNameEx(0xFF25, "NR51", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF25)
-	MakeNameEx(0xFF26, "NR52", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF26)
-	MakeNameEx(0xFF00, "JOYP", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF00)
-	MakeNameEx(0xFF01, "SB", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF01)
-	MakeNameEx(0xFF02, "SC", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF02)
-	MakeNameEx(0xFF04, "DIV", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF04)
-	MakeNameEx(0xFF05, "TIMA", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF05)
-	MakeNameEx(0xFF06, "TMA", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF06)
-	MakeNameEx(0xFF07, "TAC", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF07)
-	MakeNameEx(0xFFFF, "IE", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFFFF)
-	MakeNameEx(0xFF0F, "IF", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF0F)
-	MakeNameEx(0xFF4D, "KEY1", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF4D)
-	MakeNameEx(0xFF56, "RP", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF56)
-	MakeNameEx(0xFF70, "SVBK", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0xFF70)
-
+def naming(li):
+	apply_names("gb")
+	# CGB flag: 0x80 CGB enhanced, 0xC0 CGB only
+	li.seek(CGB_FLAG_OFFSET)
+	if struct.unpack("<B", li.read(1))[0] & 0x80:
+		apply_names("cgb")
 
 def main():
 	return 0
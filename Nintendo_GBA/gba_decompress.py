@@ -0,0 +1,273 @@
+"""
+Finder and decompressor for the GBA BIOS compression formats, independent
+from IDA.
+
+Every block starts with a header word: the format in the low byte (0x10
+LZ77, 0x30 RLE, 0x24/0x28 Huffman with 4/8-bit data) and the
+decompressed size in the upper 24 bits. Candidate headers are found on
+aligned words with a plausible size, then decompressed; streams are
+rejected as soon as they go wrong (back reference before the start,
+input overrun, bad Huffman tree), so random data costs little. The scan
+also rejects RLE streams splitting a literal run, which Nintendo's
+encoder never does, while decompress() accepts them as the BIOS does.
+
+Streams are decoded from a bytearray into a bytearray, with slice copies
+for LZ77 back references and RLE runs.
+
+usage: python gba_decompress.py rom.gba
+"""
+
+import struct
+import sys
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+LZ77		= 0x10
+HUFFMAN		= 0x20
+RLE		= 0x30
+FORMAT_NAMES	= {LZ77: "LZ77", HUFFMAN: "Huffman", RLE: "RLE"}
+
+# header types found in ROMs: Huffman carries its data size in the low nibble
+HEADER_TYPES	= (0x10, 0x24, 0x28, 0x30)
+
+# plausible decompressed sizes: at least a tile, at most EWRAM
+MIN_SIZE	= 0x20
+MAX_SIZE	= 0x40000
+
+# header and largest Huffman tree
+MAX_OVERHEAD	= 4 + 0x200
+
+U32		= struct.Struct("<I")
+
+class DecompressionError(Exception):
+	pass
+
+def _lz77(src, pos, size):
+	out = bytearray()
+	end = len(src)
+	while len(out) < size:
+		if pos >= end:
+			raise DecompressionError("input overrun")
+		flags = src[pos]
+		pos += 1
+		for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+			if len(out) >= size:
+				break
+			if not flags & bit:
+				if pos >= end:
+					raise DecompressionError("input overrun")
+				out.append(src[pos])
+				pos += 1
+				continue
+			if pos + 2 > end:
+				raise DecompressionError("input overrun")
+			b0 = src[pos]
+			b1 = src[pos + 1]
+			pos += 2
+			disp = (((b0 & 0x0F) << 8) | b1) + 1
+			length = (b0 >> 4) + 3
+			if disp > len(out):
+				raise DecompressionError("reference before start")
+			start = len(out) - disp
+			if disp >= length:
+				out += out[start:start + length]
+			else:
+				# overlapping copy repeats the last disp bytes
+				pattern = out[start:]
+				out += (pattern * (length // disp + 1))[:length]
+	return out[:size], pos
+
+def _rle(src, pos, size, strict):
+	out = bytearray()
+	end = len(src)
+	literal = False
+	while len(out) < size:
+		if pos >= end:
+			raise DecompressionError("input overrun")
+		flag = src[pos]
+		pos += 1
+		if flag & 0x80:
+			if pos >= end:
+				raise DecompressionError("input overrun")
+			out += bytearray((src[pos],)) * ((flag & 0x7F) + 3)
+			pos += 1
+			literal = False
+		else:
+			# an encoder merges literals, up to 128 bytes
+			if literal and strict:
+				raise DecompressionError("split literal run")
+			length = (flag & 0x7F) + 1
+			literal = length < 0x80
+			if pos + length > end:
+				raise DecompressionError("input overrun")
+			out += src[pos:pos + length]
+			pos += length
+	return out[:size], pos
+
+def _check_tree(src, root, tree_end, data_bits):
+	"""
+	Walk the whole tree once: every node is reached once, every child is
+	inside the tree, the leaves are distinct values, and together they
+	fill the tree, but for the padding ending it 4-byte aligned (an odd
+	number of leaves leaves 2 bytes).
+	"""
+	seen = set()
+	leaves = set()
+	nodes = [root]
+	while nodes:
+		node = nodes.pop()
+		if node in seen:
+			raise DecompressionError("bad tree")
+		seen.add(node)
+		value = src[node]
+		child = (node & ~1) + (value & 0x3F) * 2 + 2
+		if child + 1 >= tree_end:
+			raise DecompressionError("bad tree")
+		for offset, leaf in ((0, value & 0x80), (1, value & 0x40)):
+			if not leaf:
+				nodes.append(child + offset)
+				continue
+			data = src[child + offset]
+			if data in leaves or data >> data_bits:
+				raise DecompressionError("bad tree")
+			leaves.add(data)
+	# the tree, including its size byte, is tree_end - root + 1 bytes long
+	padding = tree_end - root - len(seen) - len(leaves)
+	if (tree_end - root + 1) % 4 or padding not in (0, 2):
+		raise DecompressionError("bad tree")
+
+def _huffman(src, pos, size, data_bits):
+	end = len(src)
+	if data_bits not in (4, 8):
+		raise DecompressionError("bad data size")
+	if pos >= end:
+		raise DecompressionError("input overrun")
+	tree = pos
+	# the tree, including its size byte, is (n + 1) * 2 bytes long
+	tree_end = stream = tree + (src[tree] + 1) * 2
+	if stream > end:
+		raise DecompressionError("input overrun")
+	root = tree + 1
+	_check_tree(src, root, tree_end, data_bits)
+	out = bytearray()
+	nibble = None
+	node = root
+	while len(out) < size:
+		if stream + 4 > end:
+			raise DecompressionError("input overrun")
+		bits = U32.unpack_from(src, stream)[0]
+		stream += 4
+		for shift in range(31, -1, -1):
+			value = src[node]
+			child = (node & ~1) + (value & 0x3F) * 2 + 2
+			if bits >> shift & 1:
+				child += 1
+				leaf = value & 0x40
+			else:
+				leaf = value & 0x80
+			if not leaf:
+				node = child
+				continue
+			node = root
+			data = src[child]
+			if data_bits == 8:
+				out.append(data)
+			elif nibble is None:
+				nibble = data & 0x0F
+				continue
+			else:
+				out.append(nibble | (data & 0x0F) << 4)
+				nibble = None
+			if len(out) >= size:
+				break
+	return out[:size], stream
+
+def decompress(src, offset=0, strict=False):
+	"""
+	Decompress the block at src[offset]. Returns (data, end offset).
+	Raises DecompressionError on an invalid stream, or with strict on a
+	valid but implausible one.
+	"""
+	if not isinstance(src, bytearray):
+		src = bytearray(src)
+	header = U32.unpack_from(src, offset)[0]
+	if header & 0xFF not in HEADER_TYPES:
+		raise DecompressionError("unknown format %02X" % (header & 0xFF))
+	kind = header & 0xF0
+	size = header >> 8
+	if kind == LZ77:
+		# the first block has nothing to refer to
+		if offset + 4 < len(src) and src[offset + 4] & 0x80:
+			raise DecompressionError("reference before start")
+		data, end = _lz77(src, offset + 4, size)
+	elif kind == RLE:
+		data, end = _rle(src, offset + 4, size, strict)
+	else:
+		data, end = _huffman(src, offset + 4, size, header & 0x0F)
+	return data, end
+
+def candidates(rom, min_size=MIN_SIZE, max_size=MAX_SIZE):
+	"""
+	Offsets of the aligned words looking like a compression header.
+	"""
+	count = len(rom) // 4
+	if numpy is not None:
+		w = numpy.frombuffer(rom, dtype="<u4", count=count)
+		kind = w & 0xFF
+		size = w >> 8
+		mask = (size >= min_size) & (size <= max_size)
+		types = numpy.zeros(len(w), dtype=bool)
+		for header_type in HEADER_TYPES:
+			types |= kind == header_type
+		return (numpy.nonzero(mask & types)[0] * 4).tolist()
+	result = []
+	for i, word in enumerate(struct.unpack_from("<%dI" % count, rom)):
+		if word & 0xFF in HEADER_TYPES and min_size <= word >> 8 <= max_size:
+			result.append(i * 4)
+	return result
+
+def find_compressed(rom, min_size=MIN_SIZE, max_size=MAX_SIZE):
+	"""
+	Yields (offset, format, data, end offset) of the valid compressed
+	blocks of rom, skipping the candidates inside a block already found.
+	"""
+	src = bytearray(rom)
+	skip = 0
+	for offset in candidates(rom, min_size, max_size):
+		if offset < skip:
+			continue
+		try:
+			data, end = decompress(src, offset, True)
+		except DecompressionError:
+			continue
+		# a compressed stream is not much longer than its data: flag
+		# bytes, plus a Huffman tree
+		if end - offset > len(data) + len(data) // 8 + MAX_OVERHEAD:
+			continue
+		skip = end
+		yield offset, src[offset] & 0xF0, data, end
+
+def main():
+	if len(sys.argv) < 2:
+		print("usage: %s <rom>" % sys.argv[0])
+		return 1
+	with open(sys.argv[1], "rb") as f:
+		rom = f.read()
+	start = time.time()
+	count = 0
+	total = 0
+	for offset, kind, data, end in find_compressed(rom):
+		print("%08X %-7s %6X -> %6X" % (offset, FORMAT_NAMES[kind], end - offset, len(data)))
+		count += 1
+		total += len(data)
+	elapsed = time.time() - start
+	print("%d blocks, %d bytes decompressed, %.3fs (%.1f MiB/s scanned)" % (count, total, elapsed,
+		len(rom) / max(elapsed, 1e-9) / 0x100000))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
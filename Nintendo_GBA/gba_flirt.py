@@ -0,0 +1,330 @@
+"""
+FLIRT-style library function matcher, independent from IDA.
+
+IDASGN signature files (versions 5 to 10) are parsed into one module per
+library function: its first 32 bytes as a pattern and a mask (variant
+bytes are masked out), then the CRC16 of the next bytes, its length, tail
+bytes and public names. Referenced functions are skipped, as checking
+them needs the cross references of a database.
+
+The index is a dict keyed by the first KEY_SIZE bytes of the patterns.
+Each entry maps a mask to a dict of masked prefixes, so a candidate start
+costs one lookup of its first bytes and, on a hit, one masked lookup per
+distinct mask: constant time whatever the number of signatures. Patterns
+with a variant byte in their key are kept apart and tried on every start.
+
+usage: python gba_flirt.py [-s file.sig ...] rom.gba [...]
+"""
+
+import argparse
+import binascii
+import glob
+import os
+import struct
+import sys
+import time
+import zlib
+
+SIG_DIR		= os.path.dirname(os.path.realpath(__file__))
+SIG_MAGIC	= b"IDASGN"
+# magic, version, arch, file types, OS types, app types, features, old
+# function count, CRC16, ctype, library name length, ctypes CRC16
+SIG_HEADER	= struct.Struct("<6sBBIHHHHH12sBH")
+FEATURE_COMPRESSED	= 0x10
+
+PATTERN_SIZE	= 32
+# pattern bytes indexing the signatures
+KEY_SIZE	= 4
+
+# module flags, after the last public name
+MORE_PUBLIC_NAMES		= 0x01
+READ_TAIL_BYTES			= 0x02
+READ_REFERENCED_FUNCTIONS	= 0x04
+MORE_MODULES_WITH_SAME_CRC	= 0x08
+MORE_MODULES			= 0x10
+
+FUNCTION_LOCAL	= 0x02
+
+class SignatureError(Exception):
+	pass
+
+def _str(b):
+	if str is bytes:
+		return str(b)
+	return b.decode("latin-1")
+
+class SigReader(object):
+	"""
+	Cursor over the tree of a signature file, with its variable-length
+	integers.
+	"""
+	def __init__(self, data, pos=0):
+		self.data = bytearray(data)
+		self.pos = pos
+
+	def byte(self):
+		if self.pos >= len(self.data):
+			raise SignatureError("truncated signature file")
+		b = self.data[self.pos]
+		self.pos += 1
+		return b
+
+	def short(self):
+		high = self.byte()
+		return high << 8 | self.byte()
+
+	def max_2_bytes(self):
+		b = self.byte()
+		if b & 0x80:
+			return (b & 0x7F) << 8 | self.byte()
+		return b
+
+	def multiple_bytes(self):
+		b = self.byte()
+		if b & 0x80 != 0x80:
+			return b
+		if b & 0xC0 != 0xC0:
+			return (b & 0x7F) << 8 | self.byte()
+		if b & 0xE0 != 0xE0:
+			high = (b & 0x3F) << 24 | self.byte() << 16
+			return high | self.short()
+		high = self.short()
+		return high << 16 | self.short()
+
+	def skip(self, count):
+		self.pos += count
+
+def crc16(data):
+	# CRC-16/X.25, byte-swapped, as FLIRT stores it
+	if not data:
+		return 0
+	crc = 0xFFFF
+	for b in bytearray(data):
+		for i in range(8):
+			if (crc ^ b) & 1:
+				crc = (crc >> 1) ^ 0x8408
+			else:
+				crc >>= 1
+			b >>= 1
+	crc = ~crc & 0xFFFF
+	return (crc << 8 | crc >> 8) & 0xFFFF
+
+def _parse_leaf(r, version, pattern, mask, modules):
+	read_offset = r.multiple_bytes if version >= 9 else r.max_2_bytes
+	while True:
+		crc_len = r.byte()
+		crc = r.short()
+		while True:
+			length = read_offset()
+			names = []
+			offset = 0
+			while True:
+				offset += read_offset()
+				b = r.byte()
+				local = False
+				if b < 0x20:
+					local = bool(b & FUNCTION_LOCAL)
+					b = r.byte()
+				name = bytearray()
+				while b >= 0x20:
+					name.append(b)
+					b = r.byte()
+				names.append((offset, _str(name), local))
+				flags = b
+				if not flags & MORE_PUBLIC_NAMES:
+					break
+			tails = []
+			if flags & READ_TAIL_BYTES:
+				count = r.byte() if version >= 8 else 1
+				for i in range(count):
+					tail_offset = read_offset()
+					tails.append((tail_offset, r.byte()))
+			if flags & READ_REFERENCED_FUNCTIONS:
+				count = r.byte() if version >= 8 else 1
+				for i in range(count):
+					read_offset()
+					name_len = r.byte()
+					if name_len == 0:
+						name_len = r.multiple_bytes()
+					r.skip(name_len)
+			modules.append((bytes(pattern), bytes(mask), crc_len, crc, length, tails, names))
+			if not flags & MORE_MODULES_WITH_SAME_CRC:
+				break
+		if not flags & MORE_MODULES:
+			break
+
+def _parse_tree(r, version, pattern, mask, modules):
+	count = r.multiple_bytes()
+	if count == 0:
+		_parse_leaf(r, version, pattern, mask, modules)
+		return
+	for i in range(count):
+		length = r.byte()
+		if length < 0x10:
+			variant = r.max_2_bytes()
+		elif length <= 0x20:
+			variant = r.multiple_bytes()
+		else:
+			high = r.multiple_bytes()
+			variant = high << 32 | r.multiple_bytes()
+		node_pattern = bytearray(pattern)
+		node_mask = bytearray(mask)
+		bit = 1 << (length - 1)
+		for j in range(length):
+			if variant & bit:
+				node_pattern.append(0)
+				node_mask.append(0)
+			else:
+				node_pattern.append(r.byte())
+				node_mask.append(0xFF)
+			bit >>= 1
+		_parse_tree(r, version, node_pattern, node_mask, modules)
+
+def parse_signatures(data):
+	"""
+	(library name, modules) of a signature file. A module is (pattern,
+	mask, CRC16 length, CRC16, length, tail bytes, public names), the
+	names being (offset, name, local).
+	"""
+	if len(data) < SIG_HEADER.size or data[:6] != SIG_MAGIC:
+		raise SignatureError("not a signature file")
+	(magic, version, arch, file_types, os_types, app_types, features, old_count, crc,
+		ctype, name_len, ctypes_crc) = SIG_HEADER.unpack_from(data, 0)
+	if not 5 <= version <= 10:
+		raise SignatureError("unsupported signature version %d" % version)
+	pos = SIG_HEADER.size
+	if version >= 6:
+		# function count
+		pos += 4
+	if version >= 8:
+		# pattern size
+		pos += 2
+	if version >= 10:
+		pos += 2
+	library = _str(bytearray(data[pos:pos + name_len]))
+	pos += name_len
+	tree = data[pos:]
+	if features & FEATURE_COMPRESSED:
+		tree = zlib.decompress(tree, -zlib.MAX_WBITS if version <= 6 else zlib.MAX_WBITS)
+	modules = []
+	_parse_tree(SigReader(tree), version, b"", b"", modules)
+	return library, modules
+
+def load_signatures(paths):
+	"""
+	Modules of every signature file of paths, skipping the unreadable
+	ones.
+	"""
+	modules = []
+	for path in paths:
+		f = open(path, 'rb')
+		try:
+			data = f.read()
+		finally:
+			f.close()
+		try:
+			library, file_modules = parse_signatures(data)
+		except SignatureError as e:
+			print("[-] %s: %s" % (os.path.basename(path), e))
+			continue
+		modules.extend(file_modules)
+	return modules
+
+def _int(data):
+	return int(binascii.hexlify(data), 16)
+
+def build_index(modules):
+	"""
+	{key: {mask: {masked prefix: [module, ...]}}}, key being the first
+	KEY_SIZE pattern bytes, or None for the patterns with a variant byte
+	among them.
+	"""
+	index = {}
+	for module in modules:
+		pattern, mask = module[0], module[1]
+		# short patterns are padded with variant bytes
+		padding = b"\x00" * (PATTERN_SIZE - len(pattern))
+		pattern += padding
+		mask += padding
+		key = pattern[:KEY_SIZE]
+		if mask[:KEY_SIZE] != b"\xFF" * KEY_SIZE:
+			key = None
+		int_mask = _int(mask)
+		masks = index.setdefault(key, {})
+		masks.setdefault(int_mask, {}).setdefault(_int(pattern) & int_mask, []).append(module)
+	return index
+
+def _check_module(rom, start, module):
+	pattern, mask, crc_len, crc, length, tails, names = module
+	if start + length > len(rom):
+		return False
+	if crc16(rom[start + PATTERN_SIZE:start + PATTERN_SIZE + crc_len]) != crc:
+		return False
+	for offset, value in tails:
+		ea = start + PATTERN_SIZE + crc_len + offset
+		if ea < len(rom) and rom[ea] != value:
+			return False
+	return True
+
+def match(rom, starts, index):
+	"""
+	[(offset, name)] of the public names of the modules matching at the
+	candidate starts of rom, name being None for the unnamed ("?")
+	modules. Starts matched by modules of different names are ambiguous
+	and left out.
+	"""
+	rom = bytearray(rom)
+	# room for a whole pattern at the last starts
+	window = rom + bytearray(PATTERN_SIZE)
+	wildcards = index.get(None, {})
+	names = []
+	for start in starts:
+		masks = index.get(bytes(window[start:start + KEY_SIZE]))
+		if masks is None and not wildcards:
+			continue
+		value = _int(window[start:start + PATTERN_SIZE])
+		found = []
+		for candidates in (masks or {}, wildcards):
+			for mask, prefixes in candidates.items():
+				for module in prefixes.get(value & mask, ()):
+					if _check_module(rom, start, module):
+						found.append(module)
+		if not found:
+			continue
+		if len(set(module[6][0][1] for module in found)) > 1:
+			continue
+		for offset, name, local in found[0][6]:
+			names.append((start + offset, name if name != "?" else None))
+	return names
+
+def main():
+	parser = argparse.ArgumentParser(description="FLIRT-style library matcher for GBA ROMs")
+	parser.add_argument("roms", nargs="+")
+	parser.add_argument("-s", "--sig", action="append", help="signature file (default: the .sig files next to this script)")
+	args = parser.parse_args()
+	modules = load_signatures(args.sig or sorted(glob.glob(os.path.join(SIG_DIR, "*.sig"))))
+	index = build_index(modules)
+	print("%d modules, %d keys" % (len(modules), len(index)))
+	total_starts = 0
+	total_time = 0.0
+	for path in args.roms:
+		f = open(path, 'rb')
+		try:
+			rom = f.read()
+		finally:
+			f.close()
+		start = time.time()
+		# every halfword, as Thumb functions are
+		starts = range(0, len(rom) - 1, 2)
+		names = match(rom, starts, index)
+		elapsed = time.time() - start
+		total_starts += len(starts)
+		total_time += elapsed
+		print("%s: %d names, %.3fs" % (path, len(names), elapsed))
+		for offset, name in names:
+			print("    %08X %s" % (offset, name or "(unnamed)"))
+	print("%.0f candidate starts/s" % (total_starts / max(total_time, 1e-9)))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
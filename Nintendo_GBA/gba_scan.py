@@ -0,0 +1,454 @@
+"""
+Pre-analysis scanners for GBA ROMs, independent from IDA.
+
+The ROM is viewed as an array of little-endian halfwords and scanned
+vectorially for Thumb BL instruction pairs; the decoded call targets that
+land on a push {.., lr} prologue are likely Thumb functions, to be queued
+before auto-analysis starts.
+
+It is also viewed as aligned little-endian words, to find pointers into
+the ROM, EWRAM and IWRAM. Pointers whose target is referenced several
+times, or that sit next to another pointer (tables), are kept as
+offsets. Thumb and ARM SWI instructions calling the BIOS are listed
+too.
+
+classify() scores fixed windows of the ROM: the density of always
+executed ARM words, of Thumb push / pop / bx / ldr [pc] halfwords and BL
+pairs, and of 0x00 / 0xFF padding bytes. Adjacent windows of a kind are
+merged into ARM, Thumb, data and padding ranges.
+
+NumPy is used when available; otherwise a plain loop gives the same
+results, slower.
+
+parallel_scan() splits a ROM file into chunks scanned by a process pool.
+Every worker maps the file with mmap, so the ROM is never copied: a chunk
+owns the instructions starting in [start, end) and reads one word past
+its edges. Results are merged in chunk order, so they do not depend on
+the number of workers.
+
+usage: python gba_scan.py [-j jobs] rom.gba
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
+ROM_START	= 0x08000000
+ROM_MAX_SIZE	= 0x02000000
+
+# (start, end) of the RAM regions pointers may target; ROM pointers are
+# limited to the ROM size
+RAM_REGIONS	= [(0x02000000, 0x02040000), (0x03000000, 0x03008000)]
+# references needed to keep a lone pointer
+MIN_REFS	= 2
+
+# Thumb BL: high part (H=10) then low part (H=11) of the offset
+BL_MASK		= 0xF800
+BL_HIGH		= 0xF000
+BL_LOW		= 0xF800
+# Thumb push {.., lr}
+PUSH_LR_MASK	= 0xFF00
+PUSH_LR		= 0xB500
+# Thumb swi nn / ARM swi nn0000h, nn being a BIOS function
+THUMB_SWI_MASK	= 0xFF00
+THUMB_SWI	= 0xDF00
+ARM_SWI_MASK	= 0xFF00FFFF
+ARM_SWI		= 0xEF000000
+SWI_MAX		= 0x2A
+
+# classifier windows, and their kinds
+WINDOW_SIZE	= 0x100
+ARM		= "arm"
+THUMB		= "thumb"
+DATA		= "data"
+PADDING		= "padding"
+# share of 0x00 / 0xFF bytes in a padding window
+PADDING_RATIO	= 0.9
+# share of always (AL) executed words in an ARM window
+ARM_RATIO	= 0.5
+# share of push / pop / bx / ldr [pc] halfwords and BL pairs in a Thumb
+# window; random data scores about 0.05
+THUMB_RATIO	= 0.12
+# (mask, value) of the single halfword Thumb markers
+THUMB_MARKERS	= [(0xFE00, 0xB400), (0xFE00, 0xBC00), (0xFF80, 0x4700), (0xF800, 0x4800)]
+
+# smallest chunk given to a worker
+MIN_CHUNK_SIZE	= 0x100000
+
+def halfwords(rom):
+	if numpy is not None:
+		return numpy.frombuffer(rom, dtype="<u2", count=len(rom) // 2)
+	return struct.unpack_from("<%dH" % (len(rom) // 2), rom)
+
+def words(rom):
+	if numpy is not None:
+		return numpy.frombuffer(rom, dtype="<u4", count=len(rom) // 4)
+	return struct.unpack_from("<%dI" % (len(rom) // 4), rom)
+
+def bl_calls(rom, base=ROM_START, start=0, end=None, h=None):
+	"""
+	(sources, targets) of the BL pairs whose first halfword is in
+	rom[start:end], with their target inside the ROM. The second
+	halfword may lie past end.
+	"""
+	if h is None:
+		h = halfwords(rom)
+	count = len(h)
+	lo = start // 2
+	hi = count - 1
+	if end is not None:
+		hi = min(end // 2, count - 1)
+	size = count * 2
+	if numpy is not None:
+		first = h[lo:hi]
+		second = h[lo + 1:hi + 1]
+		index = numpy.nonzero(((first & BL_MASK) == BL_HIGH) & ((second & BL_MASK) == BL_LOW))[0]
+		high = first[index].astype(numpy.int64) & 0x7FF
+		# sign extend the upper 11 bits of the 22-bit halfword offset
+		high = numpy.where(high & 0x400, high - 0x800, high)
+		low = second[index].astype(numpy.int64) & 0x7FF
+		sources = (index + lo) * 2
+		offsets = sources + 4 + (high << 12) + (low << 1)
+		inside = (offsets >= 0) & (offsets < size)
+		return sources[inside] + base, offsets[inside] + base
+	sources = []
+	targets = []
+	for i in range(lo, hi):
+		if h[i] & BL_MASK != BL_HIGH or h[i + 1] & BL_MASK != BL_LOW:
+			continue
+		high = h[i] & 0x7FF
+		if high & 0x400:
+			high -= 0x800
+		offset = i * 2 + 4 + (high << 12) + ((h[i + 1] & 0x7FF) << 1)
+		if 0 <= offset < size:
+			sources.append(base + i * 2)
+			targets.append(base + offset)
+	return sources, targets
+
+def push_lr_targets(targets, base=ROM_START, h=None, rom=None):
+	"""
+	Sorted unique targets starting with a push {.., lr}.
+	"""
+	if h is None:
+		h = halfwords(rom)
+	if numpy is not None:
+		targets = numpy.unique(numpy.asarray(targets, dtype=numpy.int64))
+		targets = targets[(h[(targets - base) // 2] & PUSH_LR_MASK) == PUSH_LR]
+		return [int(target) for target in targets]
+	return sorted(set(target for target in targets if h[(target - base) // 2] & PUSH_LR_MASK == PUSH_LR))
+
+def thumb_functions(rom, base=ROM_START):
+	"""
+	Sorted addresses of the likely Thumb functions of a ROM: BL targets
+	starting with a push {.., lr}.
+	"""
+	h = halfwords(rom)
+	sources, targets = bl_calls(rom, base, h=h)
+	return push_lr_targets(targets, base, h=h)
+
+def _pointer_mask(values, regions):
+	mask = numpy.zeros(len(values), dtype=bool)
+	for region_start, region_end in regions:
+		mask |= (values >= region_start) & (values < region_end)
+	return mask
+
+def pointer_candidates(rom, base=ROM_START, start=0, end=None, w=None):
+	"""
+	(sources, targets, paired) of the aligned words of rom[start:end]
+	pointing into the ROM or RAM. paired tells whether the previous or
+	next word is a pointer too; those may lie outside [start, end).
+	"""
+	if w is None:
+		w = words(rom)
+	count = len(w)
+	lo = start // 4
+	hi = count
+	if end is not None:
+		hi = min(end // 4, count)
+	regions = [(base, base + len(rom))] + RAM_REGIONS
+	# one word of overlap on each side for the neighbour test
+	lo_ext = max(lo - 1, 0)
+	hi_ext = min(hi + 1, count)
+	if numpy is not None:
+		mask = _pointer_mask(w[lo_ext:hi_ext], regions)
+		padded = numpy.zeros(hi_ext - lo_ext + 2, dtype=bool)
+		padded[1:-1] = mask
+		paired = padded[:-2] | padded[2:]
+		index = numpy.arange(lo_ext, hi_ext)
+		keep = mask & (index >= lo) & (index < hi)
+		return index[keep] * 4 + base, w[lo_ext:hi_ext][keep].astype(numpy.int64), paired[keep]
+	def is_pointer(i):
+		if i < 0 or i >= count:
+			return False
+		for region_start, region_end in regions:
+			if region_start <= w[i] < region_end:
+				return True
+		return False
+	sources = []
+	targets = []
+	paired = []
+	for i in range(lo, hi):
+		if is_pointer(i):
+			sources.append(base + i * 4)
+			targets.append(w[i])
+			paired.append(is_pointer(i - 1) or is_pointer(i + 1))
+	return sources, targets, paired
+
+def select_pointers(sources, targets, paired, min_refs=MIN_REFS):
+	"""
+	Keep the pointers that are paired or whose target is referenced at
+	least min_refs times. Returns (sources, targets, histogram), the
+	histogram being a {target: references} dict over all candidates.
+	"""
+	if numpy is not None:
+		sources = numpy.asarray(sources, dtype=numpy.int64)
+		targets = numpy.asarray(targets, dtype=numpy.int64)
+		unique, inverse, counts = numpy.unique(targets, return_inverse=True, return_counts=True)
+		keep = numpy.asarray(paired, dtype=bool) | (counts[inverse] >= min_refs)
+		histogram = dict(zip(unique.tolist(), counts.tolist()))
+		return sources[keep].tolist(), targets[keep].tolist(), histogram
+	histogram = {}
+	for target in targets:
+		histogram[target] = histogram.get(target, 0) + 1
+	kept = [(source, target) for source, target, pair in zip(sources, targets, paired)
+		if pair or histogram[target] >= min_refs]
+	return [source for source, target in kept], [target for source, target in kept], histogram
+
+def pointers(rom, base=ROM_START, min_refs=MIN_REFS):
+	"""
+	(sources, targets, histogram) of the high confidence pointers of a ROM.
+	"""
+	sources, targets, paired = pointer_candidates(rom, base)
+	return select_pointers(sources, targets, paired, min_refs)
+
+def swi_calls(rom, base=ROM_START, start=0, end=None, h=None, w=None):
+	"""
+	(sources, numbers) of the Thumb and ARM BIOS calls starting in
+	rom[start:end], sorted by address.
+	"""
+	if h is None:
+		h = halfwords(rom)
+	if w is None:
+		w = words(rom)
+	if end is None:
+		end = len(rom)
+	h_lo, h_hi = start // 2, min(end // 2, len(h))
+	w_lo, w_hi = start // 4, min(end // 4, len(w))
+	if numpy is not None:
+		thumb = h[h_lo:h_hi]
+		t_index = numpy.nonzero(((thumb & THUMB_SWI_MASK) == THUMB_SWI) & ((thumb & 0xFF) <= SWI_MAX))[0]
+		arm = w[w_lo:w_hi]
+		a_index = numpy.nonzero(((arm & ARM_SWI_MASK) == ARM_SWI) & (((arm >> 16) & 0xFF) <= SWI_MAX))[0]
+		sources = numpy.concatenate(((t_index + h_lo) * 2, (a_index + w_lo) * 4)).astype(numpy.int64)
+		numbers = numpy.concatenate((thumb[t_index] & 0xFF, (arm[a_index] >> 16) & 0xFF)).astype(numpy.int64)
+		order = numpy.argsort(sources, kind="mergesort")
+		return (sources[order] + base).tolist(), numbers[order].tolist()
+	calls = []
+	for i in range(h_lo, h_hi):
+		if h[i] & THUMB_SWI_MASK == THUMB_SWI and h[i] & 0xFF <= SWI_MAX:
+			calls.append((i * 2, h[i] & 0xFF))
+	for i in range(w_lo, w_hi):
+		if w[i] & ARM_SWI_MASK == ARM_SWI and (w[i] >> 16) & 0xFF <= SWI_MAX:
+			calls.append((i * 4, (w[i] >> 16) & 0xFF))
+	calls.sort()
+	return [base + offset for offset, number in calls], [number for offset, number in calls]
+
+def _window_kind(padding, arm, thumb):
+	if padding >= PADDING_RATIO:
+		return PADDING
+	if arm >= ARM_RATIO:
+		return ARM
+	if thumb >= THUMB_RATIO:
+		return THUMB
+	return DATA
+
+def window_kinds(rom, window=WINDOW_SIZE):
+	"""
+	Kind of every window of rom, the last one padded with zeros.
+	"""
+	count = (len(rom) + window - 1) // window
+	data = bytes(rom) + b"\x00" * (count * window - len(rom))
+	if numpy is not None:
+		b = numpy.frombuffer(data, dtype=numpy.uint8).reshape(count, window)
+		h = numpy.frombuffer(data, dtype="<u2").reshape(count, window // 2)
+		w = numpy.frombuffer(data, dtype="<u4").reshape(count, window // 4)
+		padding = ((b == 0) | (b == 0xFF)).mean(axis=1)
+		arm = ((w >> 28) == 0xE).mean(axis=1)
+		markers = numpy.zeros(h.shape, dtype=bool)
+		for mask, value in THUMB_MARKERS:
+			markers |= (h & mask) == value
+		pairs = ((h[:, :-1] & BL_MASK) == BL_HIGH) & ((h[:, 1:] & BL_MASK) == BL_LOW)
+		thumb = (markers.sum(axis=1) + pairs.sum(axis=1) * 2) / float(window // 2)
+		return [_window_kind(*scores) for scores in zip(padding, arm, thumb)]
+	kinds = []
+	for i in range(count):
+		chunk = bytearray(data[i * window:(i + 1) * window])
+		h = struct.unpack_from("<%dH" % (window // 2), data, i * window)
+		w = struct.unpack_from("<%dI" % (window // 4), data, i * window)
+		padding = (chunk.count(0) + chunk.count(0xFF)) / float(window)
+		arm = sum(1 for word in w if word >> 28 == 0xE) / float(len(w))
+		markers = sum(1 for half in h if any(half & mask == value for mask, value in THUMB_MARKERS))
+		pairs = sum(1 for j in range(len(h) - 1) if h[j] & BL_MASK == BL_HIGH and h[j + 1] & BL_MASK == BL_LOW)
+		kinds.append(_window_kind(padding, arm, (markers + pairs * 2) / float(len(h))))
+	return kinds
+
+def classify(rom, base=ROM_START, functions=(), window=WINDOW_SIZE):
+	"""
+	(start, end, kind) ranges of rom, adjacent windows of a kind being
+	merged. A data window holding one of the Thumb functions found by
+	the scanners is taken as Thumb.
+	"""
+	kinds = window_kinds(rom, window)
+	for ea in functions:
+		i = (ea - base) // window
+		if 0 <= i < len(kinds) and kinds[i] == DATA:
+			kinds[i] = THUMB
+	ranges = []
+	for i, kind in enumerate(kinds):
+		start = base + i * window
+		if ranges and ranges[-1][2] == kind:
+			ranges[-1] = (ranges[-1][0], start + window, kind)
+		else:
+			ranges.append((start, start + window, kind))
+	if ranges:
+		ranges[-1] = (ranges[-1][0], min(ranges[-1][1], base + len(rom)), ranges[-1][2])
+	return ranges
+
+def _tolist(values):
+	if numpy is not None:
+		return numpy.asarray(values).tolist()
+	return list(values)
+
+def scan_range(rom, base=ROM_START, start=0, end=None):
+	"""
+	Raw results of every scanner over rom[start:end]: Thumb functions,
+	BL targets, pointer candidates and BIOS calls.
+	"""
+	h = halfwords(rom)
+	w = words(rom)
+	sources, targets = bl_calls(rom, base, start, end, h)
+	functions = push_lr_targets(targets, base, h)
+	pointer_sources, pointer_targets, paired = pointer_candidates(rom, base, start, end, w)
+	swi_sources, swi_numbers = swi_calls(rom, base, start, end, h, w)
+	return {
+		"functions": functions,
+		"calls": _tolist(targets),
+		"pointers": (_tolist(pointer_sources), _tolist(pointer_targets), _tolist(paired)),
+		"swi": (swi_sources, swi_numbers)
+		}
+
+def merge_results(results, min_refs=MIN_REFS):
+	"""
+	Merge scan_range() results, given in address order: Thumb functions
+	and BL targets sorted and unique, pointers selected over the whole ROM.
+	"""
+	functions = set()
+	calls = set()
+	pointer_sources, pointer_targets, paired = [], [], []
+	swi_sources, swi_numbers = [], []
+	for result in results:
+		functions.update(result["functions"])
+		calls.update(result["calls"])
+		pointer_sources.extend(result["pointers"][0])
+		pointer_targets.extend(result["pointers"][1])
+		paired.extend(result["pointers"][2])
+		swi_sources.extend(result["swi"][0])
+		swi_numbers.extend(result["swi"][1])
+	return {
+		"functions": sorted(functions),
+		"calls": sorted(calls),
+		"pointers": select_pointers(pointer_sources, pointer_targets, paired, min_refs),
+		"swi": (swi_sources, swi_numbers)
+		}
+
+def scan(rom, base=ROM_START, min_refs=MIN_REFS):
+	return merge_results([scan_range(rom, base)], min_refs)
+
+def _scan_file_range(args):
+	# worker: map the ROM file and scan one chunk of it
+	path, size, base, start, end = args
+	f = open(path, "rb")
+	try:
+		view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			try:
+				rom = memoryview(view)[:size]
+			except TypeError:
+				# python 2 mmap objects only have the old buffer interface
+				rom = buffer(view, 0, size)
+			result = scan_range(rom, base, start, end)
+			# release the buffer before unmapping
+			del rom
+			return result
+		finally:
+			view.close()
+	finally:
+		f.close()
+
+def chunks(size, jobs, chunk_size=None):
+	"""
+	[start, end) chunks covering size bytes, word aligned, about four
+	per job for load balancing.
+	"""
+	if chunk_size is None:
+		chunk_size = max(MIN_CHUNK_SIZE, size // (jobs * 4))
+	chunk_size = (chunk_size + 3) & ~3
+	return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+def parallel_scan(path, jobs=None, base=ROM_START, min_refs=MIN_REFS, chunk_size=None):
+	"""
+	scan() of a ROM file over a pool of jobs processes. Falls back on a
+	single process when concurrent.futures is missing or jobs is 1.
+	"""
+	size = min(os.path.getsize(path), ROM_MAX_SIZE)
+	if jobs is None:
+		jobs = os.cpu_count() if hasattr(os, "cpu_count") else 1
+	tasks = [(path, size, base, start, end) for start, end in chunks(size, jobs, chunk_size)]
+	if ProcessPoolExecutor is None or jobs <= 1:
+		return merge_results([_scan_file_range(task) for task in tasks], min_refs)
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		# map() yields in task order, whatever the completion order
+		return merge_results(executor.map(_scan_file_range, tasks), min_refs)
+
+def main():
+	parser = argparse.ArgumentParser(description="GBA ROM pre-analysis scanners")
+	parser.add_argument("rom")
+	parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: one per CPU)")
+	args = parser.parse_args()
+	start = time.time()
+	result = parallel_scan(args.rom, args.jobs)
+	sources, targets, histogram = result["pointers"]
+	print("%d Thumb functions, %d pointers kept out of %d candidates, %d BIOS calls, %.3fs" % (
+		len(result["functions"]), len(sources), sum(histogram.values()), len(result["swi"][0]), time.time() - start))
+	for target, refs in sorted(histogram.items(), key=lambda item: (-item[1], item[0]))[:10]:
+		print("    %08X: %d references" % (target, refs))
+	f = open(args.rom, "rb")
+	try:
+		rom = f.read()
+	finally:
+		f.close()
+	start = time.time()
+	ranges = classify(rom, functions=result["functions"])
+	sizes = {}
+	for range_start, range_end, kind in ranges:
+		sizes[kind] = sizes.get(kind, 0) + range_end - range_start
+	print("%d ranges, %.3fs" % (len(ranges), time.time() - start))
+	for kind in (ARM, THUMB, DATA, PADDING):
+		print("    %-7s %8X bytes" % (kind, sizes.get(kind, 0)))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,13 +1,31 @@
 import idc 
 import idaapi
+import bisect
+import glob
+import os
 import struct
+import sys
+import time
+
+LOADER_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(LOADER_DIR)
+sys.path.append(os.path.join(LOADER_DIR, "..", "IO_registers"))
+from io_naming import apply_names
+import gba_scan
+import gba_decompress
+import gba_flirt
 
 ROM_SIGNATURE_OFFSET 	= 4
 ROM_SIGNATURE        	= "\x24\xFF\xAE\x51" # TO FIX more than 4 bytes
 ROM_FORMAT_NAME        	= "Nintendo GBA ROM"
 SIZE_HEADER		= 0xC0
 ROM_START		= 0x08000000
-ROM_SIZE		= 0x01000000
+# largest cartridge ROM, 0x08000000-0x09FFFFFF
+ROM_SIZE		= 0x02000000
+# wait state 1 / 2 mirrors of the ROM
+ROM_MIRRORS		= [(0x0A000000, "ROM_WS1"), (0x0C000000, "ROM_WS2")]
+# decompressed blocks go above the GBA address space
+DECOMPRESS_START	= 0x10000000
 
 def dwordAt(li, off):
 	li.seek(off)
@@ -16,9 +34,22 @@ def dwordAt(li, off):
 		return 0
 	return struct.unpack('<I', s)[0]
 
+def rom_seg_size(size):
+	# file length rounded up to a power of two, as cartridges are
+	seg_size = 0x100
+	while seg_size < size:
+		seg_size <<= 1
+	return min(seg_size, ROM_SIZE)
+
 def memset_seg(ea, size):
-	for i in xrange(0, size):
-		idc.PatchByte(ea + i, 0)
+	# one bulk write, instead of one patched byte per call
+	idaapi.put_many_bytes(ea, "\x00" * size)
+
+def phase_done(name, start):
+	# load time of one load_file phase
+	now = time.time()
+	print("[+] %s: %.3fs" % (name, now - start))
+	return now
 
 def accept_file(li, n):
 	# we support only one format per file
@@ -43,9 +74,11 @@ def load_file(li, neflags, format):
 	if jump & 0xFF000000 != 0xEA000000:
 		Warning("Unknown format name: '%s'" % format)
     		return 0
+	start = t = time.time()
 	idaapi.set_processor_type("arm", SETPROC_ALL|SETPROC_FATAL)
 	li.seek(0, idaapi.SEEK_END)
-	size = li.tell()
+	size = min(li.tell(), ROM_SIZE)
+	rom_size = rom_seg_size(size)
 
 	# Adding Header Section
 	idc.AddSeg(ROM_START, ROM_START + SIZE_HEADER, 0, 1, idaapi.saRelPara, idaapi.scPub)
@@ -60,32 +93,45 @@ def load_file(li, neflags, format):
 	idaapi.cvar.inf.beginEA = ROM_START
 
 	# Adding ROM Section
-	idc.AddSeg(ROM_START + SIZE_HEADER, ROM_START + (ROM_SIZE - SIZE_HEADER), 0, 1, idaapi.saRelPara, idaapi.scPub)
+	idc.AddSeg(ROM_START + SIZE_HEADER, ROM_START + rom_size, 0, 1, idaapi.saRelPara, idaapi.scPub)
 	idc.RenameSeg(ROM_START + SIZE_HEADER, "ROM")
 	idc.SetSegmentType(ROM_START + SIZE_HEADER, idc.SEG_CODE)
 	li.seek(SIZE_HEADER)
-	li.file2base(0, ROM_START + SIZE_HEADER, ROM_START + size, 0)
+	li.file2base(SIZE_HEADER, ROM_START + SIZE_HEADER, ROM_START + size, 0)
+
+	# Adding wait state mirrors, as empty aliases of the ROM
+	for mirror, name in ROM_MIRRORS:
+		idc.AddSeg(mirror, mirror + rom_size, 0, 1, idaapi.saRelPara, idaapi.scPub)
+		idc.RenameSeg(mirror, name)
+		idc.SetSegmentType(mirror, idc.SEG_XTRN)
+		idc.SetSegmentAttr(mirror, idc.SEGATTR_PERM, idc.SEGPERM_READ)
+		idc.ExtLinA(mirror, 0, "; mirror of ROM at %08X, not loaded" % ROM_START)
+	t = phase_done("ROM", t)
 
 	# Adding EWRAM
 	idc.AddSeg(0x02000000, 0x02040000, 0, 1, idaapi.saRelPara, idaapi.scPub)
 	idc.RenameSeg(0x02000000, "EWRAM")
 	memset_seg(0x02000000, 0x40000)
+	t = phase_done("EWRAM", t)
 
 	# Adding IWRAM
 	idc.AddSeg(0x03000000, 0x03008000, 0, 1, idaapi.saRelPara, idaapi.scPub)
 	idc.RenameSeg(0x03000000, "IWRAM")
 	memset_seg(0x03000000, 0x8000)
+	t = phase_done("IWRAM", t)
 
 	# Adding IO / Registers
 	idc.AddSeg(0x04000000, 0x04000400, 0, 1, idaapi.saRelPara, idaapi.scPub)
 	idc.RenameSeg(0x04000000, "IOregisters")
 	memset_seg(0x04000000, 0x400)
+	t = phase_done("IO", t)
 
 	# Adding BIOS System ROM
 	idc.AddSeg(0x00000000, 0x00004000, 0, 1, idaapi.saRelPara, idaapi.scPub)
 	idc.RenameSeg(0x00000000, "BIOS")
 	memset_seg(0x00000000, 0x4000)
 	idc.SetSegmentType(0x0000000, idc.SEG_CODE)
+	t = phase_done("BIOS", t)
 
 	idaapi.add_long_cmt(ROM_START, True, "ROM HEADER")
 	li.seek(0xA0)
@@ -100,237 +146,103 @@ def load_file(li, neflags, format):
 	idc.ExtLinA(ROM_START, 8,  "; Software version %02X" % struct.unpack("<B", li.read(1))[0])
 	idc.ExtLinA(ROM_START, 9,  "; Complement Check %02X" % struct.unpack("<B", li.read(1))[0])
 	idc.ExtLinA(ROM_START, 10,  "; Reserved Area : db 2 dup(0)")
+	t = phase_done("Header", t)
 	
-	io_naming()
-	print("[+] Load OK")
-	return 1
+	apply_names("gba")
+	t = phase_done("IO naming", t)
 
-def io_naming():
-	MakeNameEx(0x04000000, "LCDControl", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000000)
-	MakeNameEx(0x04000002, "Undocumented-GreenSwap", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000002)
-	MakeNameEx(0x04000004, "GeneralLCDStatus(STAT,LYC)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000004)
-	MakeNameEx(0x04000006, "VerticalCounter(LY)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000006)
-	MakeNameEx(0x04000008, "BG0Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000008)
-	MakeNameEx(0x0400000A, "BG1Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400000A)
-	MakeNameEx(0x0400000C, "BG2Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400000C)
-	MakeNameEx(0x0400000E, "BG3Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400000E)
-	MakeNameEx(0x04000010, "BG0X-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000010)
-	MakeNameEx(0x04000012, "BG0Y-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000012)
-	MakeNameEx(0x04000014, "BG1X-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000014)
-	MakeNameEx(0x04000016, "BG1Y-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000016)
-	MakeNameEx(0x04000018, "BG2X-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000018)
-	MakeNameEx(0x0400001A, "BG2Y-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400001A)
-	MakeNameEx(0x0400001C, "BG3X-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400001C)
-	MakeNameEx(0x0400001E, "BG3Y-Offset", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400001E)
-	MakeNameEx(0x04000020, "BG2Rotation/ScalingParameterA(dx)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000020)
-	MakeNameEx(0x04000022, "BG2Rotation/ScalingParameterB(dmx)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000022)
-	MakeNameEx(0x04000024, "BG2Rotation/ScalingParameterC(dy)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000024)
-	MakeNameEx(0x04000026, "BG2Rotation/ScalingParameterD(dmy)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000026)
-	MakeNameEx(0x04000028, "BG2ReferencePointX-Coordinate", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x04000028)
-	MakeNameEx(0x0400002C, "BG2ReferencePointY-Coordinate", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x0400002C)
-	MakeNameEx(0x04000030, "BG3Rotation/ScalingParameterA(dx)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000030)
-	MakeNameEx(0x04000032, "BG3Rotation/ScalingParameterB(dmx)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000032)
-	MakeNameEx(0x04000034, "BG3Rotation/ScalingParameterC(dy)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000034)
-	MakeNameEx(0x04000036, "BG3Rotation/ScalingParameterD(dmy)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000036)
-	MakeNameEx(0x04000038, "BG3ReferencePointX-Coordinate", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x04000038)
-	MakeNameEx(0x0400003C, "BG3ReferencePointY-Coordinate", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x0400003C)
-	MakeNameEx(0x04000040, "Window0HorizontalDimensions", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000040)
-	MakeNameEx(0x04000042, "Window1HorizontalDimensions", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000042)
-	MakeNameEx(0x04000044, "Window0VerticalDimensions", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000044)
-	MakeNameEx(0x04000046, "Window1VerticalDimensions", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000046)
-	MakeNameEx(0x04000048, "InsideofWindow0and1", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000048)
-	MakeNameEx(0x0400004A, "InsideofOBJWindow&OutsideofWindows", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400004A)
-	MakeNameEx(0x0400004C, "MosaicSize", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400004C)
-	MakeNameEx(0x0400004E, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000050, "ColorSpecialEffectsSelection", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000050)
-	MakeNameEx(0x04000052, "AlphaBlendingCoefficients", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000052)
-	MakeNameEx(0x04000054, "Brightness(Fade-In/Out)Coefficient", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000054)
-	MakeNameEx(0x04000056, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000060, "Channel1Sweepregister(NR10)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000060)
-	MakeNameEx(0x04000062, "Channel1Duty/Length/Envelope(NR11,NR12)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000062)
-	MakeNameEx(0x04000064, "Channel1Frequency/Control(NR13,NR14)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000064)
-	MakeNameEx(0x04000066, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000068, "Channel2Duty/Length/Envelope(NR21,NR22)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000068)
-	MakeNameEx(0x0400006A, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x0400006C, "Channel2Frequency/Control(NR23,NR24)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400006C)
-	MakeNameEx(0x0400006E, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000070, "Channel3Stop/WaveRAMselect(NR30)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000070)
-	MakeNameEx(0x04000072, "Channel3Length/Volume(NR31,NR32)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000072)
-	MakeNameEx(0x04000074, "Channel3Frequency/Control(NR33,NR34)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000074)
-	MakeNameEx(0x04000076, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000078, "Channel4Length/Envelope(NR41,NR42)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000078)
-	MakeNameEx(0x0400007A, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x0400007C, "Channel4Frequency/Control(NR43,NR44)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400007C)
-	MakeNameEx(0x0400007E, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000080, "ControlStereo/Volume/Enable(NR50,NR51)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000080)
-	MakeNameEx(0x04000082, "ControlMixing/DMAControl", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000082)
-	MakeNameEx(0x04000084, "ControlSoundon/off(NR52)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000084)
-	MakeNameEx(0x04000086, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000088, "SoundPWMControl", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000088)
-	MakeNameEx(0x0400008A, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000090, "Channel3WavePatternRAM(2banks!!)", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x040000A0, "ChannelAFIFO,Data0-3", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000A0)
-	MakeNameEx(0x040000A4, "ChannelBFIFO,Data0-3", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000A4)
-	MakeNameEx(0x040000A8, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x040000B0, "DMA0SourceAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000B0)
-	MakeNameEx(0x040000B4, "DMA0DestinationAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000B4)
-	MakeNameEx(0x040000B8, "DMA0WordCount", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000B8)
-	MakeNameEx(0x040000BA, "DMA0Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000BA)
-	MakeNameEx(0x040000BC, "DMA1SourceAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000BC)
-	MakeNameEx(0x040000C0, "DMA1DestinationAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000C0)
-	MakeNameEx(0x040000C4, "DMA1WordCount", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000C4)
-	MakeNameEx(0x040000C6, "DMA1Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000C6)
-	MakeNameEx(0x040000C8, "DMA2SourceAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000C8)
-	MakeNameEx(0x040000CC, "DMA2DestinationAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000CC)
-	MakeNameEx(0x040000D0, "DMA2WordCount", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000D0)
-	MakeNameEx(0x040000D2, "DMA2Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000D2)
-	MakeNameEx(0x040000D4, "DMA3SourceAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000D4)
-	MakeNameEx(0x040000D8, "DMA3DestinationAddress", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x040000D8)
-	MakeNameEx(0x040000DC, "DMA3WordCount", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000DC)
-	MakeNameEx(0x040000DE, "DMA3Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x040000DE)
-	MakeNameEx(0x040000E0, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000100, "Timer0Counter/Reload", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000100)
-	MakeNameEx(0x04000102, "Timer0Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000102)
-	MakeNameEx(0x04000104, "Timer1Counter/Reload", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000104)
-	MakeNameEx(0x04000106, "Timer1Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000106)
-	MakeNameEx(0x04000108, "Timer2Counter/Reload", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000108)
-	MakeNameEx(0x0400010A, "Timer2Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400010A)
-	MakeNameEx(0x0400010C, "Timer3Counter/Reload", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400010C)
-	MakeNameEx(0x0400010E, "Timer3Control", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400010E)
-	MakeNameEx(0x04000110, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000120, "SIOData(Normal-32bitMode)(sharedwithbelow!)", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x04000120)
-	MakeNameEx(0x04000120, "SIOData0(Parent)(Multi-PlayerMode)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000120)
-	MakeNameEx(0x04000122, "SIOData1(1stChild)(Multi-PlayerMode)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000122)
-	MakeNameEx(0x04000124, "SIOData2(2ndChild)(Multi-PlayerMode)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000124)
-	MakeNameEx(0x04000126, "SIOData3(3rdChild)(Multi-PlayerMode)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000126)
-	MakeNameEx(0x04000128, "SIOControlRegister", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000128)
-	MakeNameEx(0x0400012A, "SIOData(LocalofMulti-Player)(sharedbelow)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400012A)
-	MakeNameEx(0x0400012A, "SIOData(Normal-8bitandUARTMode)", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x0400012A)
-	MakeNameEx(0x0400012C, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000130, "KeyStatus", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000130)
-	MakeNameEx(0x04000132, "KeyInterruptControl", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000132)
-	MakeNameEx(0x04000134, "SIOModeSelect/GeneralPurposeData", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000134)
-	MakeNameEx(0x04000136, "IRAncient-InfraredRegister(Prototypesonly)", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000138, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000140, "SIOJOYBusControl", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000140)
-	MakeNameEx(0x04000142, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000150, "SIOJOYBusReceiveData", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x04000150)
-	MakeNameEx(0x04000154, "SIOJOYBusTransmitData", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x04000154)
-	MakeNameEx(0x04000158, "SIOJOYBusReceiveStatus", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000158)
-	MakeNameEx(0x0400015A, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000200, "InterruptEnableRegister", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000200)
-	MakeNameEx(0x04000202, "InterruptRequestFlags/IRQAcknowledge", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000202)
-	MakeNameEx(0x04000204, "GamePakWaitstateControl", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000204)
-	MakeNameEx(0x04000206, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000208, "InterruptMasterEnableRegister", SN_NOCHECK | SN_NOWARN)
-	MakeWord(0x04000208)
-	MakeNameEx(0x0400020A, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000300, "Undocumented-PostBootFlag", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0x04000300)
-	MakeNameEx(0x04000301, "Undocumented-PowerDownControl", SN_NOCHECK | SN_NOWARN)
-	MakeByte(0x04000301)
-	MakeNameEx(0x04000302, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000411, "Notused", SN_NOCHECK | SN_NOWARN)
-	MakeNameEx(0x04000800, "Undocumented-InternalMemoryControl(R/W)", SN_NOCHECK | SN_NOWARN)
-	MakeDword(0x04000800)
-	MakeNameEx(0x04000804, "Notused", SN_NOCHECK | SN_NOWARN)
+	li.seek(0)
+	rom = li.read(size)
+	scan = gba_scan.scan(rom, ROM_START)
+	t = phase_done("Scanners", t)
+	sources, targets, histogram = scan["pointers"]
+	mark_regions(gba_scan.classify(rom, ROM_START, scan["functions"]), sources)
+	t = phase_done("Regions", t)
+	queue_thumb_functions(scan["functions"])
+	apply_pointers(sources, targets)
+	t = phase_done("Functions and pointers", t)
+
+	apply_signatures(rom, scan)
+	t = phase_done("Signatures", t)
+
+	if idc.AskYN(0, "Scan the ROM for BIOS-compressed data (LZ77, RLE, Huffman)?") == 1:
+		add_decompressed(rom)
+		t = phase_done("Decompression", t)
+	print("[+] Load OK (%.3fs)" % (t - start))
+	return 1
 
+def mark_regions(ranges, pointers):
+	# T register over the code ranges, so auto-analysis decodes them in
+	# the right mode, and byte arrays over the data and padding ranges,
+	# leaving room for the pointers applied after
+	counts = {}
+	for start, end, kind in ranges:
+		counts[kind] = counts.get(kind, 0) + 1
+		if kind == gba_scan.THUMB:
+			idc.SetRegEx(start, "T", 1, idc.SR_user)
+			continue
+		idc.SetRegEx(start, "T", 0, idc.SR_user)
+		if kind == gba_scan.ARM:
+			continue
+		ea = start
+		i = bisect.bisect_left(pointers, start)
+		while ea < end:
+			stop = end
+			if i < len(pointers) and pointers[i] < end:
+				stop = pointers[i]
+				i += 1
+			if stop > ea:
+				idc.MakeByte(ea)
+				idc.MakeArray(ea, stop - ea)
+			ea = stop + 4
+	print("[+] %s ranges marked" % ", ".join("%d %s" % (counts.get(kind, 0), kind)
+		for kind in (gba_scan.ARM, gba_scan.THUMB, gba_scan.DATA, gba_scan.PADDING)))
+
+def queue_thumb_functions(functions):
+	# Thumb state, then a function for auto-analysis to start from
+	for ea in functions:
+		idc.SetRegEx(ea, "T", 1, idc.SR_user)
+		idc.AutoMark(ea, idc.AU_PROC)
+	print("[+] %d Thumb functions queued" % len(functions))
+
+def apply_pointers(sources, targets):
+	# offsets create the data xrefs to their targets
+	for ea, target in zip(sources, targets):
+		idc.MakeDword(ea)
+		idc.OpOff(ea, 0, 0)
+	print("[+] %d pointers applied" % len(sources))
+
+def apply_signatures(rom, scan):
+	# the library signatures shipped with the loader, tried on every BL
+	# target, prologue-less leaves included, and on the BIOS call sites
+	# (the swi N; bx lr stubs), then named in one batch
+	index = gba_flirt.build_index(gba_flirt.load_signatures(
+		sorted(glob.glob(os.path.join(LOADER_DIR, "*.sig")))))
+	starts = sorted(set(scan["calls"]) | set(scan["swi"][0]))
+	names = gba_flirt.match(rom, [ea - ROM_START for ea in starts], index)
+	for offset, name in names:
+		if name is None:
+			idc.MakeComm(ROM_START + offset, "library function (unnamed signature)")
+		else:
+			idc.MakeNameEx(ROM_START + offset, name, idc.SN_NOCHECK | idc.SN_NOWARN)
+	print("[+] %d library functions matched" % len(names))
+
+def add_decompressed(rom):
+	# one DATA segment per compressed block, named after its ROM offset
+	ea = DECOMPRESS_START
+	count = 0
+	for offset, kind, data, end in gba_decompress.find_compressed(rom):
+		name = "%s_%08X" % (gba_decompress.FORMAT_NAMES[kind], ROM_START + offset)
+		seg_end = ea + ((len(data) + 0xFF) & ~0xFF)
+		idc.AddSeg(ea, seg_end, 0, 1, idaapi.saRelPara, idaapi.scPub)
+		idc.RenameSeg(ea, name)
+		idc.SetSegmentType(ea, idc.SEG_DATA)
+		idaapi.put_many_bytes(ea, str(data))
+		idc.MakeNameEx(ROM_START + offset, name.lower(), idc.SN_NOCHECK | idc.SN_NOWARN)
+		idc.MakeComm(ROM_START + offset, "%s, %X bytes decompressed at %08X" % (name, len(data), ea))
+		ea = seg_end
+		count += 1
+	print("[+] %d compressed blocks added" % count)
 
 def main():
 	return 0
@@ -0,0 +1,174 @@
+"""
+Round-trip tests of gba_decompress, against small reference encoders.
+
+usage: python -m unittest test_gba_decompress
+"""
+
+import os
+import random
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from gba_decompress import DecompressionError, decompress, find_compressed
+
+def _header(kind, size):
+	return bytearray(struct.pack("<I", kind | size << 8))
+
+def _align(out):
+	while len(out) % 4:
+		out.append(0)
+	return out
+
+def lz77(data):
+	# greedy encoder, matches of 3 to 18 bytes up to 4 KiB back
+	out = _header(0x10, len(data))
+	i = 0
+	while i < len(data):
+		flags_pos = len(out)
+		out.append(0)
+		for bit in range(8):
+			if i >= len(data):
+				break
+			best_len, best_disp = 0, 0
+			for disp in range(1, min(i, 0x1000) + 1):
+				length = 0
+				while length < 18 and i + length < len(data) and data[i + length - disp] == data[i + length]:
+					length += 1
+				if length > best_len:
+					best_len, best_disp = length, disp
+			if best_len >= 3:
+				out[flags_pos] |= 0x80 >> bit
+				out.append((best_len - 3) << 4 | (best_disp - 1) >> 8)
+				out.append((best_disp - 1) & 0xFF)
+				i += best_len
+			else:
+				out.append(data[i])
+				i += 1
+	return _align(out)
+
+def rle(data):
+	# runs of 3 to 130 bytes, literal runs of up to 128 bytes
+	out = _header(0x30, len(data))
+	i = 0
+	literal = bytearray()
+	while i < len(data):
+		run = 1
+		while i + run < len(data) and run < 130 and data[i + run] == data[i]:
+			run += 1
+		if run >= 3:
+			if literal:
+				out.append(len(literal) - 1)
+				out += literal
+				literal = bytearray()
+			out.append(0x80 | (run - 3))
+			out.append(data[i])
+			i += run
+			continue
+		literal.append(data[i])
+		i += 1
+		if len(literal) == 0x80:
+			out.append(0x7F)
+			out += literal
+			literal = bytearray()
+	if literal:
+		out.append(len(literal) - 1)
+		out += literal
+	return _align(out)
+
+def huffman(data, data_bits, tree, codes):
+	# hand-built tree, codes being the bit strings of the symbols
+	out = _header(0x20 | data_bits, len(data))
+	out += bytearray(tree)
+	symbols = []
+	for b in bytearray(data):
+		if data_bits == 8:
+			symbols.append(b)
+		else:
+			symbols += [b & 0x0F, b >> 4]
+	bits = "".join(codes[symbol] for symbol in symbols)
+	bits += "0" * (-len(bits) % 32)
+	for i in range(0, len(bits), 32):
+		out += struct.pack("<I", int(bits[i:i + 32], 2))
+	return out
+
+# 3 symbols: a tree of 6 bytes, padded to 8
+TREE_3 = [0x03, 0x80, 0x00, 0xC0, 0x01, 0x02, 0x00, 0x00]
+CODES_3 = {0: "0", 1: "10", 2: "11"}
+# 4 symbols, no padding
+TREE_4 = [0x03, 0x00, 0xC0, 0xC1, 0x41, 0x42, 0x43, 0x44]
+CODES_4 = {0x41: "00", 0x42: "01", 0x43: "10", 0x44: "11"}
+# the same tree over the nibbles 0-3
+TREE_NIBBLES = [0x03, 0x00, 0xC0, 0xC1, 0x00, 0x01, 0x02, 0x03]
+CODES_NIBBLES = {0: "00", 1: "01", 2: "10", 3: "11"}
+
+class RoundTripTest(unittest.TestCase):
+
+	def assertRoundTrip(self, stream, data):
+		# the stream ends at its last used byte, before the alignment
+		out, end = decompress(stream)
+		self.assertEqual(out, data)
+		self.assertEqual((end + 3) & ~3, len(stream))
+
+	def setUp(self):
+		self.random = random.Random(1)
+		self.data = bytearray()
+		while len(self.data) < 0x800:
+			self.data += bytearray([self.random.randrange(4)]) * self.random.randrange(1, 20)
+
+	def test_lz77(self):
+		stream = lz77(self.data)
+		self.assertRoundTrip(stream, self.data)
+
+	def test_rle(self):
+		stream = rle(self.data)
+		self.assertRoundTrip(stream, self.data)
+
+	def test_huffman_8bit(self):
+		data = bytearray(self.random.choice(b"ABCD") for i in range(0x100))
+		stream = huffman(data, 8, TREE_4, CODES_4)
+		self.assertRoundTrip(stream, data)
+
+	def test_huffman_4bit_odd_symbols(self):
+		data = bytearray(self.random.randrange(3) | self.random.randrange(3) << 4 for i in range(0x100))
+		stream = huffman(data, 4, TREE_3, CODES_3)
+		self.assertRoundTrip(stream, data)
+
+	def test_find_compressed(self):
+		rom = bytearray(self.random.getrandbits(8) for i in range(0x10000))
+		blocks = {0x1000: lz77(self.data), 0x4000: rle(self.data),
+			0x8000: huffman(self.data, 4, TREE_NIBBLES, CODES_NIBBLES)}
+		for offset, stream in blocks.items():
+			rom[offset:offset + len(stream)] = stream
+		found = dict((offset, (kind, data)) for offset, kind, data, end in find_compressed(rom))
+		for offset in blocks:
+			self.assertEqual(found.get(offset, (None, None))[1], self.data)
+
+class RejectTest(unittest.TestCase):
+
+	def test_reference_before_start(self):
+		self.assertRaises(DecompressionError, decompress, _header(0x10, 0x20) + bytearray([0x80, 0x00, 0x00, 0x00]))
+
+	def test_input_overrun(self):
+		self.assertRaises(DecompressionError, decompress, rle(bytearray(range(0x40)))[:-8])
+
+	def test_split_literal_run(self):
+		# valid, but not what Nintendo's encoder writes
+		stream = _align(_header(0x30, 0x20) + bytearray([0x0F]) + bytearray(0x10) + bytearray([0x0F]) + bytearray(0x10))
+		self.assertEqual(decompress(stream)[0], bytearray(0x20))
+		self.assertRaises(DecompressionError, decompress, stream, 0, True)
+		rom = bytearray(0x100) + stream + bytearray(0x100)
+		self.assertEqual(list(find_compressed(rom)), [])
+
+	def test_unaligned_tree(self):
+		# 2 symbols in a 6-byte tree
+		stream = _header(0x28, 0x20) + bytearray([0x02, 0xC0, 0x41, 0x42, 0x00, 0x00]) + bytearray(8)
+		self.assertRaises(DecompressionError, decompress, stream)
+
+	def test_random_data(self):
+		rom = bytearray(random.Random(2).getrandbits(8) for i in range(0x40000))
+		self.assertEqual(list(find_compressed(rom)), [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,8 +1,15 @@
 import idc
 import idaapi
+import os
 import struct
+import sys
 import ctypes
 
+LOADER_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(LOADER_DIR)
+sys.path.append(os.path.join(LOADER_DIR, "..", "IO_registers"))
+from io_naming import apply_names
+
 ROM_SIGNATURE_OFFSET        = 0
 ROM_SIGNATURE               = "NES\x1A"
 ROM_FORMAT_NAME             = "Nintendo NES ROM"
@@ -174,7 +181,7 @@ def load_file(li, neflags, format):
     else:
         Warning("Mapper %d is not supported" % mapper_version)
 
-    naming()
+    apply_names("nes")
 
     idaapi.add_entry(Word(0xFFFC), Word(0xFFFC), "start", 1)
     idaapi.cvar.inf.startIP = Word(0xFFFC)
@@ -193,74 +200,3 @@ def describe_header_info(li):
     idaapi.describe(0x00, True, "; Number of 8K RAM : 0x%02X" % struct.unpack("<B", li.read(1))[0])
     idaapi.describe(0x00, True, "-------------------------------")
 
-def naming():
-    MakeNameEx(0xFFFA, "NMI_vector", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0xFFFA)
-    MakeNameEx(0xFFFC, "RESET_vector", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0xFFFC)
-    MakeNameEx(0xFFFE, "IRQ_vector", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0xFFFE)
-    MakeNameEx(0x2000, "PPU_Control_Register_1", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2000)
-    MakeNameEx(0x2001, "PPU_Control_Register_2", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2001)
-    MakeNameEx(0x2002, "PPU_Status_Register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2002)
-    MakeNameEx(0x2003, "SPR-RAM_Address_Register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2003)
-    MakeNameEx(0x2004, "SPR-RAM_Data_Register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2004)
-    MakeNameEx(0x2005, "PPU_Background_Scrolling_Offset", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2005)
-    MakeNameEx(0x2006, "VRAM_Address_Register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2006)
-    MakeNameEx(0x2007, "VRAM_Read/Write_Data_Register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x2007)
-    MakeNameEx(0x4000, "APU_Channel_1_(Rectangle)_Volume/Decay", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4000)
-    MakeNameEx(0x4001, "APU_Channel_1_(Rectangle)_Sweep", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4001)
-    MakeNameEx(0x4002, "APU_Channel_1_(Rectangle)_Frequency", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4002)
-    MakeNameEx(0x4003, "APU_Channel_1_(Rectangle)_Length", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4003)
-    MakeNameEx(0x4004, "APU_Channel_2_(Rectangle)_Volume/Decay", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4004)
-    MakeNameEx(0x4005, "APU_Channel_2_(Rectangle)_Sweep", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4005)
-    MakeNameEx(0x4006, "APU_Channel_2_(Rectangle)_Frequency", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4006)
-    MakeNameEx(0x4007, "APU_Channel_2_(Rectangle)_Length", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4007)
-    MakeNameEx(0x4008, "APU_Channel_3_(Triangle)_Linear_Counter", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4008)
-    MakeNameEx(0x4009, "APU_Channel_3_(Triangle)_N/A", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4009)
-    MakeNameEx(0x400A, "APU_Channel_3_(Triangle)_Frequency", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x400A)
-    MakeNameEx(0x400B, "APU_Channel_3_(Triangle)_Length", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x400B)
-    MakeNameEx(0x400C, "APU_Channel_4_(Noise)_Volume/Decay", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x400C)
-    MakeNameEx(0x400D, "APU_Channel_4_(Noise)_N/A", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x400D)
-    MakeNameEx(0x400E, "APU_Channel_4_(Noise)_Frequency", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x400E)
-    MakeNameEx(0x400F, "APU_Channel_4_(Noise)_Length", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x400F)
-    MakeNameEx(0x4010, "APU_Channel_5_(DMC)_Play_mode_and_DMA_frequency", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4010)
-    MakeNameEx(0x4011, "APU_Channel_5_(DMC)_Delta_counter_load_register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4011)
-    MakeNameEx(0x4012, "APU_Channel_5_(DMC)_Address_load_register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4012)
-    MakeNameEx(0x4013, "APU_Channel_5_(DMC)_Length_register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4013)
-    MakeNameEx(0x4014, "SPR-RAM_DMA_Register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4014)
-    MakeNameEx(0x4015, "DMC/IRQ/length_counter_status/channel_enable_register", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4015)
-    MakeNameEx(0x4016, "Joypad_#1_(RW)", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4016)
-    MakeNameEx(0x4017, "Joypad_#2/APU_SOFTCLK_(RW)", SN_NOCHECK | SN_NOWARN)
-    MakeWord(0x4017)
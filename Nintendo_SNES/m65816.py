@@ -1,10 +1,36 @@
 from idaapi import *
+import gc
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from m65816_decoder import branch_target, DecodingError, DecodeCache, MNEMONICS, MAX_INSN_SIZE
+from m65816_decoder import FLAG_C, FLAG_X, FLAG_M, FLAG_E, FLAGS_RESET
+from m65816_flow import next_flags, UNKNOWN_SHIFT
 
 # TYPE FOR LONG
 o_long		= 42
 
-class DecodingError(Exception):
-    pass
+# segment register value of a flag that differs between incoming paths
+SR_UNKNOWN	= 2
+
+# decoded instructions kept between ana() calls
+DECODE_CACHE_SIZE	= 4096
+
+def build_itype_table(instrs):
+	itypes = dict((ins['name'], idx) for idx, ins in enumerate(instrs))
+	return [itypes[name] for name in MNEMONICS]
+
+class m65816_idb_hooks_t(IDB_Hooks):
+	# drop cached instructions over patched bytes
+	def __init__(self, cache):
+		IDB_Hooks.__init__(self)
+		self.cache = cache
+
+	def byte_patched(self, ea):
+		self.cache.invalidate(ea)
+		return 0
 
 class m65816_processor_t(idaapi.processor_t):
     	"""
@@ -64,7 +90,9 @@ class m65816_processor_t(idaapi.processor_t):
 		"PC",		# Program Counter
             	# Fake segment registers
             	"CS",
-            	"DS"
+            	"DS",
+		# M / X / E flags, tracked as segment registers
+		"MF", "XF", "EF"
 		]
 
     	instruc = instrs = [
@@ -89,11 +117,11 @@ class m65816_processor_t(idaapi.processor_t):
 		# BPL
 		{'name': 'bpl',  'feature': CF_USE1 | CF_USE2, 'cmt': "Branches if negative flag clear."},
 		# BRA
-		{'name': 'bra',  'feature': CF_USE1 | CF_USE2, 'cmt': "Branches always."},
+		{'name': 'bra',  'feature': CF_USE1 | CF_STOP, 'cmt': "Branches always."},
 		# BRK
 		{'name': 'brk',  'feature': CF_STOP, 'cmt': "Causes a software break. The PC is loaded from a vector table from somewhere around $FFE6."},
 		# BRL
-		{'name': 'brl',  'feature': CF_USE1 | CF_USE2, 'cmt': "Branch Relative Long."},
+		{'name': 'brl',  'feature': CF_USE1 | CF_STOP, 'cmt': "Branch Relative Long."},
 		# BVC
 		{'name': 'bvc',  'feature': CF_USE1 | CF_USE2, 'cmt': "Branches if overflow flag is clear."},
 		# BVS
@@ -129,13 +157,13 @@ class m65816_processor_t(idaapi.processor_t):
 		# INY
 		{'name': 'iny',  'feature': CF_USE1 | CF_USE2, 'cmt': "Increment Y"},
 		# JMP
-		{'name': 'jmp',  'feature': CF_USE1, 'cmt': "Jump to location"},
+		{'name': 'jmp',  'feature': CF_USE1 | CF_STOP, 'cmt': "Jump to location"},
 		# JML
-		{'name': 'jml',  'feature': CF_USE1 | CF_USE2, 'cmt': "Jump long"},
+		{'name': 'jml',  'feature': CF_USE1 | CF_STOP, 'cmt': "Jump long"},
 		# JSR
-		{'name': 'jsr',  'feature': CF_USE1, 'cmt': "Jump subroutine"},
+		{'name': 'jsr',  'feature': CF_USE1 | CF_CALL, 'cmt': "Jump subroutine"},
 		# JSL
-		{'name': 'jsl',  'feature': CF_USE1 | CF_USE2, 'cmt': "Jump subroutine long"},
+		{'name': 'jsl',  'feature': CF_USE1 | CF_CALL, 'cmt': "Jump subroutine long"},
 		# LDA
 		{'name': 'lda',  'feature': CF_USE1 | CF_USE2, 'cmt': "Load Accumulator with memory"},
 		# LDX
@@ -195,9 +223,9 @@ class m65816_processor_t(idaapi.processor_t):
 		# RTI
 		{'name': 'rti',  'feature': CF_STOP, 'cmt': "Return from Interupt"},
 		# RTS
-		{'name': 'rts',  'feature': CF_USE1 | CF_USE2, 'cmt': "Return from Subroutine"},
+		{'name': 'rts',  'feature': CF_STOP, 'cmt': "Return from Subroutine"},
 		# RTL
-		{'name': 'rtl',  'feature': CF_USE1 | CF_USE2, 'cmt': "Return from Subroutine long"},
+		{'name': 'rtl',  'feature': CF_STOP, 'cmt': "Return from Subroutine long"},
 		# SBC
 		{'name': 'sbc',  'feature': CF_USE1 | CF_USE2, 'cmt': "Substract with carry"},
 		# SEC
@@ -215,7 +243,7 @@ class m65816_processor_t(idaapi.processor_t):
 		# STY
 		{'name': 'sty',  'feature': CF_USE1 | CF_USE2, 'cmt': "Store Y to memory"},
 		# STP
-		{'name': 'stp',  'feature': CF_USE1 | CF_USE2, 'cmt': "Stop the clock"},
+		{'name': 'stp',  'feature': CF_STOP, 'cmt': "Stop the clock"},
 		# STZ
 		{'name': 'stz',  'feature': CF_USE1 | CF_USE2, 'cmt': "Stop zero to memory"},
 		# TAX
@@ -261,610 +289,334 @@ class m65816_processor_t(idaapi.processor_t):
 		processor_t.__init__(self)
 		self._init_instructions()
 		self._init_registers()
+		self.cache = DecodeCache(DECODE_CACHE_SIZE)
+		self.idb_hooks = m65816_idb_hooks_t(self.cache)
+		self.idb_hooks.hook()
+
+	def notify_term(self):
+		self.idb_hooks.unhook()
+		hits, misses, ratio = self.cache.stats()
+		print("m65816: decode cache %d hits, %d misses (%.1f%%)" % (hits, misses, ratio * 100))
 
 	def _init_instructions(self):
-		self.inames = {}
-		for idx, ins in enumerate(self.instrs):
-	    		self.inames[ins['name']] = idx
+		self.flag_itypes = frozenset((ITYPE_REP, ITYPE_SEP, ITYPE_XCE, ITYPE_PLP))
+		self.jump_itypes = frozenset((ITYPE_JMP, ITYPE_JML, ITYPE_JSR, ITYPE_JSL))
 
 	def _init_registers(self):
 		self.reg_ids = {}
 		for i, reg in enumerate(self.reg_names):
 	    		self.reg_ids[reg] = i
         	self.regFirstSreg = self.regCodeSreg = self.reg_ids["CS"]
-        	self.regLastSreg = self.regDataSreg = self.reg_ids["DS"]
-
-
-	def _read_cmd_byte(self):
-        	ea = self.cmd.ea + self.cmd.size
-        	byte = get_full_byte(ea)
-        	self.cmd.size += 1
-        	return byte
-
-	def _read_cmd_word(self):
-        	ea = self.cmd.ea + self.cmd.size
-        	byte = get_full_byte(ea)
-		byte |= get_full_byte(ea + 1) << 8
-        	self.cmd.size += 2		
-        	return byte
-
-	def _read_cmd_lword(self):
-        	ea = self.cmd.ea + self.cmd.size
-        	byte = get_full_byte(ea)
-		byte |= get_full_byte(ea + 1) << 8
-		byte |= get_full_byte(ea + 2) << 16
-        	self.cmd.size += 3
-        	return byte
-
-	def u8_to_s8(self, n):
-		if (n & 0x80):
-			return n - 0x100
-		return n
-
-	def handle_dp_indexed_indirect_X(self):
+		self.regDataSreg = self.reg_ids["DS"]
+		self.regLastSreg = self.reg_ids["EF"]
+		self.flag_sregs = (
+			(self.reg_ids["MF"], FLAG_M),
+			(self.reg_ids["XF"], FLAG_X),
+			(self.reg_ids["EF"], FLAG_E)
+			)
+
+
+	def _get_flags(self, ea):
+		# M/X/E state at ea; unset (BADSEL) and unknown values decode as 8-bit
+		flags = 0
+		for reg, bit in self.flag_sregs:
+			value = getSR(ea, reg)
+			if value != 0:
+				flags |= bit
+				if value != 1:
+					flags |= bit << UNKNOWN_SHIFT
+		return flags
+
+	def _propagate_flags(self, ea, flags):
+		"""
+		Record the state flowing into ea. A value set explicitly by
+		another path and disagreeing with this one becomes SR_UNKNOWN,
+		so every address changes state at most twice. Code already
+		decoded under the former state is decoded again.
+		"""
+		changed = False
+		for reg, bit in self.flag_sregs:
+			if (flags >> UNKNOWN_SHIFT) & bit:
+				value = SR_UNKNOWN
+			elif flags & bit:
+				value = 1
+			else:
+				value = 0
+			old = getSR(ea, reg)
+			if old == value or old == SR_UNKNOWN:
+				continue
+			if old in (0, 1):
+				area = getSRarea(ea)
+				if area is not None and area.startEA == ea:
+					value = SR_UNKNOWN
+			splitSRarea1(ea, reg, value, SR_auto)
+			changed = True
+		if changed and isCode(getFlags(ea)):
+			self._reanalyze(ea)
+
+	def _reanalyze(self, ea):
+		# the instructions from ea to the end of its state area, decoded
+		# with stale immediate widths, are deleted and queued again
+		area = getSRarea(ea)
+		end = area.endEA if area is not None else ea + 1
+		head = ea
+		while head < end and isCode(getFlags(head)):
+			next_head = get_item_end(head)
+			do_unknown(head, DOUNK_SIMPLE)
+			head = next_head
+		auto_mark_range(ea, head, AU_CODE)
+
+	def _carry_before(self, ea, flags):
+		# resolve the carry for XCE from a CLC / SEC right before it
+		prev = ea - 1
+		if get_item_head(prev) == prev:
+			opcode = get_full_byte(prev)
+			if opcode == 0x18:
+				return flags & ~FLAG_C
+			if opcode == 0x38:
+				return flags | FLAG_C
+		return flags | FLAG_C | (FLAG_C << UNKNOWN_SHIFT)
+
+	def _fetch_window(self, ea):
+		window = get_many_bytes(ea, MAX_INSN_SIZE)
+		if window is None:
+			# short read at the end of a segment: take what is loaded
+			for n in xrange(MAX_INSN_SIZE - 1, 0, -1):
+				window = get_many_bytes(ea, n)
+				if window is not None:
+					break
+			else:
+				raise DecodingError()
+		return window
+
+	def handle_implied(self, insn):
+		pass
+
+	def handle_accumulator(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_displ
-		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
-		cmd[0].reg = 1
+		cmd[0].type = o_reg
+		cmd[0].reg = 0
 		cmd[1].type = o_void
 
-	def handle_stack_relative(self):
+	# register pushed / pulled by each stack opcode
+	push_pull_regs = {
+		0x48: 0, 0x68: 0,		# PHA / PLA
+		0xDA: 1, 0xFA: 1,		# PHX / PLX
+		0x5A: 2, 0x7A: 2,		# PHY / PLY
+		0x8B: 4, 0xAB: 4,		# PHB / PLB
+		0x0B: 7, 0x2B: 7,		# PHD / PLD
+		0x4B: 9,			# PHK
+		0x08: 10, 0x28: 10		# PHP / PLP
+		}
+
+	def handle_push_pull(self, insn):
+		cmd = self.cmd
+		cmd[0].type = o_reg
+		cmd[0].reg = self.push_pull_regs[insn.opcode]
+
+	def handle_immediate(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_imm
-		cmd[0].dtype = dt_byte
-		cmd[0].value = self._read_cmd_byte()
-		cmd[1].type = o_reg
-		cmd[1].reg = 3
+		if insn.size == 3:
+			cmd[0].dtype = dt_word
+		else:
+			cmd[0].dtype = dt_byte
+		cmd[0].value = insn.operand
+		cmd[1].type = o_void
 
-	def handle_direct_page(self):
+	def handle_direct_page(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_mem
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
+		cmd[0].addr = insn.operand
 		cmd[1].type = o_void
 
-	def handle_dp_indirect_long(self):
+	def handle_dp_indexed_X(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_long
+		cmd[0].type = o_mem
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
-		cmd[1].type = o_void
+		cmd[0].addr = insn.operand
+		cmd[1].type = o_reg
+		cmd[1].reg = 1
 
-	def handle_immediate(self):
+	def handle_dp_indexed_Y(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_imm
+		cmd[0].type = o_mem
 		cmd[0].dtype = dt_byte
-		cmd[0].value = self._read_cmd_byte()
-		cmd[1].type = o_void
+		cmd[0].addr = insn.operand
+		cmd[1].type = o_reg
+		cmd[1].reg = 2
 
-	def handle_absolute(self):
+	def handle_dp_indirect(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_mem
-		cmd[0].dtype = dt_word
-		cmd[0].addr = self._read_cmd_word()
+		cmd[0].type = o_phrase
+		cmd[0].dtype = dt_byte
+		cmd[0].addr = insn.operand
+		cmd[0].reg = -1
 		cmd[1].type = o_void
 
-	def handle_absolute_long(self):
+	def handle_dp_indexed_indirect_X(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_mem
-		cmd[0].dtype = dt_dword
-		cmd[0].addr = self._read_cmd_lword()
+		cmd[0].type = o_displ
+		cmd[0].dtype = dt_byte
+		cmd[0].addr = insn.operand
+		cmd[0].reg = 1
 		cmd[1].type = o_void
-	
-	def handle_dp_indirect_indexed_Y(self):
+
+	def handle_dp_indirect_indexed_Y(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_phrase
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
+		cmd[0].addr = insn.operand
 		cmd[0].reg = -1
 		cmd[1].type = o_reg
 		cmd[1].reg = 2
 
-	def handle_dp_indirect(self):
+	def handle_dp_indirect_long(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_phrase
+		cmd[0].type = o_long
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
-		cmd[0].reg = -1
+		cmd[0].addr = insn.operand
 		cmd[1].type = o_void
 
-	def handle_stack_relative_indirect_indexed_Y(self):
+	def handle_dp_indirect_long_indexed_Y(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_displ
+		cmd[0].type = o_long
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
-		cmd[0].reg = 3
+		cmd[0].addr = insn.operand
 		cmd[1].type = o_reg
 		cmd[1].reg = 2
 
-	def handle_dp_indexed_X(self):
+	def handle_stack_relative(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_mem
+		cmd[0].type = o_imm
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
+		cmd[0].value = insn.operand
 		cmd[1].type = o_reg
-		cmd[1].reg = 1
+		cmd[1].reg = 3
 
-	def handle_dp_indirect_long_indexed_Y(self):
+	def handle_stack_relative_indirect_indexed_Y(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_long
+		cmd[0].type = o_displ
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self._read_cmd_byte()
+		cmd[0].addr = insn.operand
+		cmd[0].reg = 3
 		cmd[1].type = o_reg
 		cmd[1].reg = 2
 
-	def handle_absolute_indexed_Y(self):
+	def handle_absolute(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_mem
 		cmd[0].dtype = dt_word
-		cmd[0].addr = self._read_cmd_word()
-		cmd[1].type = o_reg
-		cmd[1].reg = 2
+		cmd[0].addr = insn.operand
+		cmd[1].type = o_void
 
-	def handle_absolute_indexed_X(self):
+	def handle_absolute_indexed_X(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_mem
 		cmd[0].dtype = dt_word
-		cmd[0].addr = self._read_cmd_word()
+		cmd[0].addr = insn.operand
 		cmd[1].type = o_reg
 		cmd[1].reg = 1
 
-	def handle_accumulator(self):
+	def handle_absolute_indexed_Y(self, insn):
 		cmd = self.cmd
-		cmd[0].type = o_reg
-		cmd[0].reg = 0
+		cmd[0].type = o_mem
+		cmd[0].dtype = dt_word
+		cmd[0].addr = insn.operand
+		cmd[1].type = o_reg
+		cmd[1].reg = 2
+
+	def handle_absolute_long(self, insn):
+		cmd = self.cmd
+		cmd[0].type = o_mem
+		cmd[0].dtype = dt_dword
+		cmd[0].addr = insn.operand
 		cmd[1].type = o_void
-		
-	def handle_absolute_long_indexed_X(self):
+
+	def handle_absolute_long_indexed_X(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_mem
 		cmd[0].dtype = dt_dword
-		cmd[0].addr = self._read_cmd_lword()
+		cmd[0].addr = insn.operand
 		cmd[1].type = o_reg
 		cmd[1].reg = 1
 
-	def handle_absolute_indirect(self):
+	def handle_absolute_indirect(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_phrase
 		cmd[0].dtype = dt_word
-		cmd[0].addr = self._read_cmd_word()
+		cmd[0].addr = insn.operand
 		cmd[0].reg = 0xFFFF
 
-	def handle_absolute_indexed_indirect(self):
+	def handle_absolute_indexed_indirect(self, insn):
 		cmd = self.cmd
 		cmd[0].type = o_displ
 		cmd[0].dtype = dt_word
-		cmd[0].addr = self._read_cmd_word()
+		cmd[0].addr = insn.operand
 		cmd[0].reg = 1
-	
-	def handle_absolute_indirect_long(self):
-		self.handle_absolute_indirect()
-
-	def handle_type(self, opcode):
-		table_handle = [
-				self.handle_immediate, 				# 0x00 TO CHECK !
-				self.handle_dp_indexed_indirect_X, 		# 0x01
-				self.handle_immediate, 				# 0x02 TO CHECK !
-				self.handle_stack_relative, 			# 0x03
-				self.handle_direct_page, 			# 0x04 TO CHECK !
-				self.handle_direct_page, 			# 0x05
-				self.handle_direct_page, 			# 0x06 TO CHECK !
-				self.handle_dp_indirect_long, 			# 0x07
-				0,						# 0x08
-				self.handle_immediate,				# 0x09
-				self.handle_accumulator,			# 0x0A
-				0,						# 0x0B
-				self.handle_absolute,				# 0x0C
-				self.handle_absolute,				# 0x0D
-				self.handle_absolute,				# 0x0E TO CHECK !
-				self.handle_absolute_long,			# 0x0F
-				0,						# 0x10
-				self.handle_dp_indirect_indexed_Y,		# 0x11
-				self.handle_dp_indirect,			# 0x12
-				self.handle_stack_relative_indirect_indexed_Y,	# 0x13
-				self.handle_dp_indexed_X,			# 0x14 TO CHECK !
-				self.handle_dp_indexed_X,			# 0x15
-				self.handle_dp_indexed_X,			# 0x16 TO CHECK !
-				self.handle_dp_indirect_long_indexed_Y,		# 0x17
-				0,						# 0x18
-				self.handle_absolute_indexed_Y,			# 0x19
-				self.handle_accumulator,			# 0x1A TO CHECK !
-				0,						# 0x1B
-				self.handle_absolute_indexed_X,			# 0x1C
-				self.handle_absolute_indexed_X,			# 0x1D
-				self.handle_absolute_indexed_X,			# 0x1E TO CHECK !
-				self.handle_absolute_long_indexed_X		# 0x1F
-				]
-		table_handle[opcode & 0x1F]()
-
-	def handle_branch(self):
+
+	def handle_absolute_indirect_long(self, insn):
+		self.handle_absolute_indirect(insn)
+
+	def handle_branch(self, insn):
+		cmd = self.cmd
 		cmd[0].type = o_near
+		if insn.size == 3:
+			cmd[0].dtype = dt_word
+		else:
+			cmd[0].dtype = dt_byte
+		cmd[0].addr = branch_target(insn)
+
+	def handle_block_move(self, insn):
+		cmd = self.cmd
+		cmd[0].type = o_mem
 		cmd[0].dtype = dt_byte
-		cmd[0].addr = self.cmd.ea + self.u8_to_s8(self._read_cmd_byte()) + 2
-
-	def handle_jump(self, opcode):
-		if opcode == 0x4C:
-			self.handle_absolute()
-		elif opcode == 0x5C:
-			self.handle_absolute_long()
-		elif opcode == 0x6C:
-			self.handle_absolute_indirect()
-		elif opcode == 0x7C:
-			self.handle_absolute_indexed_indirect()
-		elif opcode == 0xDC:
-			self.handle_absolute_indirect_long()
-
-	def handle_jsr(self, opcode):
-		if opcode == 0x20:
-			self.handle_absolute()
-		elif opcode == 0x22:
-			self.handle_absolute_long()
-		elif opcode == 0xFC:
-			self.handle_absolute_indexed_indirect()
-
-	def handle_push_pull(self, opcode, reg):
-		cmd[0].type = o_reg
-		cmd[0].reg = reg
+		cmd[0].addr = insn.operand & 0xFF
+		cmd[1].type = o_mem
+		cmd[1].dtype = dt_byte
+		cmd[1].addr = insn.operand >> 8
+
+	# operand handler for each decoder addressing mode, shared by all instances
+	mode_handlers = (
+		handle_implied,					# MODE_IMPLIED
+		handle_accumulator,				# MODE_ACCUMULATOR
+		handle_push_pull,				# MODE_STACK
+		handle_immediate,				# MODE_IMMEDIATE_M
+		handle_immediate,				# MODE_IMMEDIATE_X
+		handle_immediate,				# MODE_IMMEDIATE_8
+		handle_direct_page,				# MODE_DIRECT_PAGE
+		handle_dp_indexed_X,				# MODE_DP_INDEXED_X
+		handle_dp_indexed_Y,				# MODE_DP_INDEXED_Y
+		handle_dp_indirect,				# MODE_DP_INDIRECT
+		handle_dp_indexed_indirect_X,			# MODE_DP_INDEXED_INDIRECT_X
+		handle_dp_indirect_indexed_Y,			# MODE_DP_INDIRECT_INDEXED_Y
+		handle_dp_indirect_long,			# MODE_DP_INDIRECT_LONG
+		handle_dp_indirect_long_indexed_Y,		# MODE_DP_INDIRECT_LONG_INDEXED_Y
+		handle_stack_relative,				# MODE_STACK_RELATIVE
+		handle_stack_relative_indirect_indexed_Y,	# MODE_STACK_RELATIVE_INDIRECT_INDEXED_Y
+		handle_absolute,				# MODE_ABSOLUTE
+		handle_absolute_indexed_X,			# MODE_ABSOLUTE_INDEXED_X
+		handle_absolute_indexed_Y,			# MODE_ABSOLUTE_INDEXED_Y
+		handle_absolute_long,				# MODE_ABSOLUTE_LONG
+		handle_absolute_long_indexed_X,			# MODE_ABSOLUTE_LONG_INDEXED_X
+		handle_absolute_indirect,			# MODE_ABSOLUTE_INDIRECT
+		handle_absolute_indexed_indirect,		# MODE_ABSOLUTE_INDEXED_INDIRECT
+		handle_absolute_indirect_long,			# MODE_ABSOLUTE_INDIRECT_LONG
+		handle_branch,					# MODE_RELATIVE
+		handle_branch,					# MODE_RELATIVE_LONG
+		handle_block_move				# MODE_BLOCK_MOVE
+		)
+
+	# decoder mnemonic index -> itype
+	itypes = build_itype_table(instrs)
 
     	def _ana(self):
 		cmd = self.cmd
-		opcode = self._read_cmd_byte()
-		# ADC
-		if opcode in [0x61, 0x63, 0x65, 0x67, 0x69, 0x6D, 0x6F, 0x71, 0x72, 0x73, 0x75, 0x77, 0x79, 0x7D, 0x7F]:
-			cmd.itype = self.inames["adc"]
-			self.handle_type(opcode)
-		# AND
-		elif opcode in [0x21, 0x23, 0x25, 0x27, 0x29, 0x2D, 0x2F, 0x31, 0x32, 0x33, 0x35, 0x37, 0x39, 0x3D, 0x3F]:
-			cmd.itype = self.inames["and"]
-			self.handle_type(opcode)
-		# ASL
-		elif opcode in [0x06, 0x0A, 0x0E, 0x16, 0x1E]:
-			cmd.itype = self.inames["asl"]
-			self.handle_type(opcode)
-		# BIT
-		elif opcode in [0x24, 0x2C, 0x34, 0x3C, 0x89]:
-			cmd.itype = self.inames["bit"]
-			self.handle_type(opcode)
-		# BCC
-		elif opcode == 0x90:
-			cmd.itype = self.inames["bcc"]
-			self.handle_branch()
-		# BCS
-		elif opcode == 0xB0:
-			cmd.itype = self.inames["bcs"]
-			self.handle_branch()
-		# BEQ
-		elif opcode == 0xF0:
-			cmd.itype = self.inames["beq"]
-			self.handle_branch()
-		# BMI
-		elif opcode == 0x30:
-			cmd.itype = self.inames["bmi"]
-			self.handle_branch()
-		# BNE
-		elif opcode == 0xD0:
-			cmd.itype = self.inames["bne"]
-			self.handle_branch()
-		# BPL
-		elif opcode == 0x10:
-			cmd.itype = self.inames["bpl"]
-			self.handle_branch()
-		# BRA
-		elif opcode == 0x80:
-			cmd.itype = self.inames["bra"]
-			self.handle_branch()
-		# BRK
-		elif opcode == 0x00:
-			cmd.itype = self.inames["brk"]
-		# BRL
-		elif opcode == 0x82:
-			cmd.itype = self.inames["brl"]
-			cmd[0].type = o_near
-			cmd[0].dtype = dt_word
-			dst = self._read_cmd_word()
-			cmd[0].addr = self.cmd.ea + dst + 3
-		# BVC
-		elif opcode == 0x50:
-			cmd.itype = self.inames["bvc"]
-			self.handle_branch()
-		# BVS
-		elif opcode == 0x70:
-			cmd.itype = self.inames["bvs"]
-			self.handle_branch()
-		# CLC
-		elif opcode == 0x18:
-			cmd.itype = self.inames["clc"]
-		# CLD
-		elif opcode == 0xD8:
-			cmd.itype = self.inames["cld"]
-		# CLI
-		elif opcode == 0x58:
-			cmd.itype = self.inames["cli"]
-		# CLV
-		elif opcode == 0xB8:
-			cmd.itype = self.inames["clv"]
-		# CMP
-		elif opcode in [0xC1, 0xC3, 0xC5, 0xC7, 0xC9, 0xCD, 0xCF, 0xD1, 0xD2, 0xD3, 0xD5, 0xD7, 0xD9, 0xDD, 0xDF]:
-			cmd.itype = self.inames["cmp"]
-			self.handle_type(opcode)
-		# COP
-		elif opcode == 0x02:
-			cmd.itype = self.inames["cop"]
-			cmd[0].type = o_imm
-			cmd[0].dtyp = dt_byte
-			cmd[0].value = self._read_cmd_byte()
-		# CPX
-		elif opcode in [0xE0, 0xE4, 0xEC]:
-			cmd.itype = self.inames["cpx"]
-			self.handle_type(opcode)
-		# CPY
-		elif opcode in [0xC0, 0xC4, 0xCC]:
-			cmd.itype = self.inames["cpy"]
-			self.handle_type(opcode)
-		# DEC
-		elif opcode in [0x3A, 0xC6, 0xCE, 0xD6, 0xDE]:
-			cmd.itype = self.inames["dec"]
-			self.handle_type(opcode)
-		# DEX
-		elif opcode == 0xCA:
-			cmd.itype = self.inames["dex"]
-		# DEY
-		elif opcode == 0x88:
-			cmd.itype = self.inames["dey"]
-		# EOR
-		elif opcode in [0x41, 0x43, 0x45, 0x47, 0x49, 0x4D, 0x4F, 0x51, 0x52, 0x53, 0x55, 0x57, 0x59, 0x5D, 0x5F]:
-			cmd.itype = self.inames["eor"]
-			self.handle_type(opcode)
-		# INC
-		elif opcode in [0x1A, 0xE6, 0xEE, 0xF6, 0xFE]:
-			cmd.itype = self.inames["inc"]
-		# INX
-		elif opcode == 0xE8:
-			cmd.itype = self.inames["inx"]
-		# INY
-		elif opcode == 0xC8:
-			cmd.itye = self.inames["iny"]
-		# JML
-		elif opcode in [0xDC]:
-			cmd.itype = self.inames["jml"]
-			self.handle_jump(opcode)
-		# JMP
-		elif opcode in [0x4C, 0x5C, 0x6C, 0x7C, 0xDC]:
-			cmd.itype = self.inames["jmp"]
-			self.handle_jump(opcode)
-		# JSL
-		elif opcode == 0x22:
-			cmd.itype = self.inames["jsl"]
-		# JSR
-		elif opcode in [0x20, 0xFC]:
-			cmd.itype = self.inames["jsr"]
-			self.handle_jsr(opcode)
-		# LDA
-		elif opcode in [0xA1, 0xA3, 0xA5, 0xA7, 0xA9, 0xAD, 0xAF, 0xB1, 0xB2, 0xB3, 0xB5, 0xB7, 0xB9, 0xBD, 0xBF]:
-			cmd.itype = self.inames["lda"]
-			self.handle_type(opcode)
-		# LDX
-		elif opcode in [0xA2, 0xA6, 0xAE, 0xB6, 0xBE]:
-			cmd.itype = self.inames["ldx"]
-			self.handle_type(opcode)
-		# LDY
-		elif opcode in [0xA0, 0xA4, 0xAC, 0xB4, 0xBC]:
-			cmd.itype = self.inames["ldy"]
-			self.handle_type(opcode)
-		# LSR
-		elif opcode in [0x46, 0x4A, 0x4E, 0x56, 0x5E]:
-			cmd.itype = self.inames["lsr"]
-			self.handle_type(opcode)
-		# MVN
-		elif opcode == 0x54:
-			cmd.itype = self.inames["mvn"]
-			cmd[0].type = o_mem
-			cmd[0].dtyp = dt_byte
-			cmd[0].addr = self._read_cmd_byte()
-			cmd[1].type = o_mem
-			cmd[1].dtyp = dt_byte
-			cmd[1].addr = self._read_cmd_byte()
-		# MVS
-		elif opcode == 0x44:
-			cmd.itype = self.inames["mvs"]
-			cmd[0].type = o_mem
-			cmd[0].dtyp = dt_byte
-			cmd[0].addr = self._read_cmd_byte()
-			cmd[1].type = o_mem
-			cmd[1].dtyp = dt_byte
-			cmd[1].addr = self._read_cmd_byte()
-		# NOP
-		elif opcode == 0xEA:
-			cmd.itype = self.inames["nop"]
-		# ORA
-		elif opcode in [0x01, 0x03, 0x05, 0x07, 0x09, 0x0D, 0x0F, 0x11, 0x12, 0x13, 0x15, 0x17, 0x19, 0x1D, 0x1F]:
-			cmd.itype = self.inames["ora"]
-			self.handle_type(opcode)
-		# PEA
-		elif opcode == 0xF4:
-			cmd.itype = self.inames["pea"]
-			cmd[0].type = o_mem
-			cmd[0].dtype = dt_word
-			cmd[0].addr = self._read_cmd_word()
-		# PEI
-		elif opcode == 0xD4:
-			cmd.itype = self.inames["pei"]
-			cmd[0].type = o_phrase
-			cmd[0].dtype = dt_byte
-			cmd[0].addr = self._read_cmd_byte()
-			cmd[0].reg = -1
-		# PER
-		elif opcode == 0x62: # TO CHECK
-			cmd.itype = self.inames["per"]
-			self.handle_branch()
-		# PHA
-		elif opcode == 0x48:
-			cmd.itype = self.inames["pha"]
-			self.handle_push_pull(opcode, 0)
-		# PHB
-		elif opcode == 0x8B:
-			cmd.itype = self.inames["phb"]
-			self.handle_push_pull(opcode, 4)
-		# PHD
-		elif opcode == 0x0B:
-			cmd.itype = self.inames["phd"]
-			self.handle_push_pull(opcode, 7)
-		# PHK
-		elif opcode == 0x4B:
-			cmd.itype = self.inames["phk"]
-			self.handle_push_pull(opcode, 9)
-		# PHP
-		elif opcode == 0x08:
-			cmd.itype = self.inames["php"]
-			self.handle_push_pull(opcode, 10)
-		# PHX
-		elif opcode == 0xDA:
-			cmd.itype = self.inames["phx"]
-			self.handle_push_pull(opcode, 1)
-		# PHY
-		elif opcode == 0x5A:
-			cmd.itype = self.inames["phy"]
-			self.handle_push_pull(opcode, 2)
-		# PLA
-		elif opcode == 0x68:
-			cmd.itype = self.inames["pla"]
-			self.handle_push_pull(opcode, 0)
-		# PLB
-		elif opcode == 0xAB:
-			cmd.itype = self.inames["plb"]
-			self.handle_push_pull(opcode, 4)
-		# PLD
-		elif opcode == 0x2B:
-			cmd.itype = self.inames["pld"]
-			self.handle_push_pull(opcode, 7)
-		# PLP
-		elif opcode == 0x28:
-			cmd.itype = self.inames["plp"]
-			self.handle_push_pull(opcode, 10)
-		# PLX
-		elif opcode == 0xFA:
-			cmd.itype = self.inames["plx"]
-			self.handle_push_pull(opcode, 1)	
-		# PLY
-		elif opcode == 0x7A:
-			cmd.itype = self.inames["ply"]
-			self.handle_push_pull(opcode, 2)
-		# REP
-		elif opcode == 0xC2:
-			cmd.itype = self.inames["rep"]
-			self.handle_type(opcode)
-		# ROL
-		elif opcode in [0x26, 0x2A, 0x2E, 0x36, 0x3E]:
-			cmd.itype = self.inames["rol"]
-			self.handle_type(opcode)
-		# ROR
-		elif opcode in [0x66, 0x6A, 0x6E, 0x76, 0x7E]:
-			cmd.itype = self.inames["ror"]
-			self.handle_type(opcode)
-		# RTI
-		elif opcode == 0x40:
-			cmd.itype = self.inames["rti"]
-		# RTL
-		elif opcode == 0x6B:
-			cmd.itype = self.inames["rtl"]
-		# RTS
-		elif opcode == 0x60:
-			cmd.itype = self.inames["rts"]
-		# SBC
-		elif opcode in [0xE1, 0xE3, 0xE5, 0xE7, 0xE9, 0xED, 0xEF, 0xF1, 0xF2, 0xF3, 0xF5, 0xF7, 0xF9, 0xFD, 0xFF]:
-			cmd.itype = self.inames["sbc"]
-			self.handle_type(opcode)
-		# SEC
-		elif opcode == 0x38:
-			cmd.itype = self.inames["sec"]
-		# SED
-		elif opcode == 0xF8:
-			cmd.itype = self.inames["sed"]
-		# SEI
-		elif opcode == 0x78:
-			cmd.itype = self.inames["sei"]
-		# SEP
-		elif opcode == 0xE2:
-			cmd.itype = self.inames["sep"]
-		# STA 
-		elif opcode in [0x81, 0x83, 0x85, 0x87, 0x8D, 0x8F, 0x91, 0x92, 0x93, 0x95, 0x97, 0x99, 0x9D, 0x9F]:
-			cmd.itype = self.inames["sta"]
-			self.handle_type(opcode)
-		# STP
-		elif opcode == 0xDB:
-			cmd.itype = self.inames["stp"]
-		# STX
-		elif opcode in [0x86, 0x8E, 0x96]:
-			cmd.itype = self.inames["stx"]
-			self.handle_type(opcode)
-		# STY
-		elif opcode in [0x84, 0x8C, 0x94]:
-			cmd.itype = self.inames["sty"]
-			self.handle_type(opcode)
-		# STZ
-		elif opcode in [0x64, 0x74, 0x9C, 0x9E]:
-			cmd.itype = self.inames["stz"]
-			self.handle_type(opcode)
-		# TAX
-		elif opcode == 0xAA:
-			cmd.itype = self.inames["tax"]
-		# TAY
-		elif opcode == 0xA8:
-			cmd.itype = self.inames["tay"]
-		# TCD
-		elif opcode == 0x5B:
-			cmd.itype = self.inames["tcd"]
-		# TCS
-		elif opcode == 0x1B:
-			cmd.itype = self.inames["tcs"]
-		# TDC
-		elif opcode == 0x7B:
-			cmd.itype = self.inames["tdc"]
-		# TRB
-		elif opcode in [0x14, 0x1C]:
-			cmd.itype = self.inames["trb"]
-			self.handle_type(opcode)
-		# TSB
-		elif opcode in [0x04, 0x0C]:
-			cmd.itype = self.inames["tsb"]
-			self.handle_type(opcode)
-		# TSC
-		elif opcode == 0x3B:
-			cmd.itype = self.inames["tsc"]
-		# TSX
-		elif opcode == 0xBA:
-			cmd.itype = self.inames["tsx"]
-		# TXA
-		elif opcode == 0x8A:
-			cmd.itype = self.inames["txa"]
-		# TXS
-		elif opcode == 0x9A:
-			cmd.itype = self.inames["txs"]
-		# TXY
-		elif opcode == 0x9B:
-			cmd.itype = self.inames["txy"]
-		# TYA
-		elif opcode == 0x98:
-			cmd.itype = self.inames["tya"]
-		# TYX
-		elif opcode == 0xBB:
-			cmd.itype = self.inames["tyx"]
-		# WAI
-		elif opcode == 0xCB:
-			cmd.itype = self.inames["wai"]
-		# WDM
-		elif opcode == 0x42:
-			cmd.itype = self.inames["wdm"]
-			self._read_cmd_byte()
-		# XBA
-		elif opcode == 0xEB:
-			cmd.itype = self.inames["xba"]
-		# XCE
-		elif opcode == 0xFB:
-			cmd.itype = self.inames["xce"]
-		else:
-			raise DecodingError()
+		insn = self.cache.decode(self._fetch_window(cmd.ea), cmd.ea, self._get_flags(cmd.ea))
+		cmd.itype = self.itypes[insn.mnemonic]
+		cmd.size = insn.size
+		self.mode_handlers[insn.mode](self, insn)
 		return cmd.size
 
     	def ana(self):
@@ -873,28 +625,57 @@ class m65816_processor_t(idaapi.processor_t):
         	except DecodingError:
 			return 0
 
-	def _emu_operand(self, op):
-		if op.type == o_mem:
+	def _emu_operand(self, op, flags):
+		cmd = self.cmd
+		if op.type == o_mem and cmd.itype in self.jump_itypes:
+			if cmd.size == 4:
+				target = op.addr
+			else:
+				# JMP / JSR absolute stay in the program bank
+				target = (cmd.ea & 0xFF0000) | op.addr
+			self._emu_flow(target, flags)
+		elif op.type == o_mem:
 			ua_dodata2(0, op.addr, op.dtyp)
 			ua_add_dref(0, op.addr, dr_R)
+        	elif op.type == o_near and cmd.itype == ITYPE_PER:
+			# PER only pushes the address, control stays here
+			ua_add_dref(0, op.addr, dr_O)
         	elif op.type == o_near:
-            		if self.cmd.get_canon_feature() & CF_CALL:
-                		fl = fl_CN
-            		else:
-                		fl = fl_JN
-            		ua_add_cref(0, op.addr, fl)
+			self._emu_flow(op.addr, flags)
+
+	def _emu_flow(self, target, flags):
+		if self.cmd.get_canon_feature() & CF_CALL:
+			fl = fl_CN
+		else:
+			fl = fl_JN
+		ua_add_cref(0, target, fl)
+		self._propagate_flags(target, flags)
+
+	def _emu_flags(self, flags):
+		# state after the instruction, for REP / SEP / XCE / PLP
+		cmd = self.cmd
+		if cmd.itype not in self.flag_itypes:
+			return flags
+		if cmd.itype == ITYPE_XCE:
+			flags = self._carry_before(cmd.ea, flags)
+		insn = self.cache.decode(self._fetch_window(cmd.ea), cmd.ea, flags)
+		return next_flags(insn, flags)[0]
 
     	def emu(self):
         	cmd = self.cmd
         	ft = cmd.get_canon_feature()
+		flags = self._get_flags(cmd.ea)
         	if ft & CF_USE1:
-            		self._emu_operand(cmd[0])
+            		self._emu_operand(cmd[0], flags)
         	if ft & CF_USE2:
-            		self._emu_operand(cmd[1])
+            		self._emu_operand(cmd[1], flags)
         	if ft & CF_USE3:
-            		self._emu_operand(cmd[2])
+            		self._emu_operand(cmd[2], flags)
         	if not ft & CF_STOP:
             		ua_add_cref(0, cmd.ea + cmd.size, fl_F)
+			after = self._emu_flags(flags)
+			if after != flags:
+				self._propagate_flags(cmd.ea + cmd.size, after)
         	return True
 
 	def outop(self, op):
@@ -965,6 +746,93 @@ class m65816_processor_t(idaapi.processor_t):
 
 
 
+# itypes of the instructions emu handles specially
+ITYPE_JMP = m65816_processor_t.itypes[MNEMONICS.index("jmp")]
+ITYPE_JML = m65816_processor_t.itypes[MNEMONICS.index("jml")]
+ITYPE_JSR = m65816_processor_t.itypes[MNEMONICS.index("jsr")]
+ITYPE_JSL = m65816_processor_t.itypes[MNEMONICS.index("jsl")]
+ITYPE_PER = m65816_processor_t.itypes[MNEMONICS.index("per")]
+ITYPE_PLP = m65816_processor_t.itypes[MNEMONICS.index("plp")]
+ITYPE_REP = m65816_processor_t.itypes[MNEMONICS.index("rep")]
+ITYPE_SEP = m65816_processor_t.itypes[MNEMONICS.index("sep")]
+ITYPE_XCE = m65816_processor_t.itypes[MNEMONICS.index("xce")]
+
+class bench_op_t(object):
+	def __init__(self):
+		self.type = o_void
+		self.dtype = dt_byte
+		self.addr = 0
+		self.value = 0
+		self.reg = 0
+
+class bench_cmd_t(object):
+	# stand-in for cmd, with the operand fields the mode handlers set
+	def __init__(self):
+		self.ea = 0
+		self.itype = 0
+		self.size = 0
+		self.ops = (bench_op_t(), bench_op_t(), bench_op_t())
+
+	def __getitem__(self, n):
+		return self.ops[n]
+
+class bench_processor_t(m65816_processor_t):
+	# _ana over a byte buffer with a fixed M/X/E state, without IDB hooks
+	def __init__(self, buf, flags):
+		processor_t.__init__(self)
+		self._init_instructions()
+		self._init_registers()
+		self.cache = DecodeCache(DECODE_CACHE_SIZE)
+		self.cmd = bench_cmd_t()
+		self.buf = buf
+		self.flags = flags
+
+	def _fetch_window(self, ea):
+		return self.buf[ea:ea + MAX_INSN_SIZE]
+
+	def _get_flags(self, ea):
+		return self.flags
+
+def allocated_blocks():
+	# live heap blocks where the interpreter counts them (Python 3.4+),
+	# else the objects tracked by the garbage collector
+	if hasattr(sys, "getallocatedblocks"):
+		return sys.getallocatedblocks()
+	return len(gc.get_objects())
+
+def bench_ana(buf, flags=FLAGS_RESET, repeat=3):
+	"""
+	Runs _ana, decode cache then mode_handlers[insn.mode], over every
+	instruction of buf. Returns (instruction count, decodes/s, blocks
+	left allocated per instruction), the first pass filling the decode
+	cache. From the IDA console: m65816.bench_ana(GetManyBytes(start, n)).
+	"""
+	proc = bench_processor_t(buf, flags)
+	cmd = proc.cmd
+	end = len(buf) - MAX_INSN_SIZE
+	def sweep():
+		count = 0
+		ea = 0
+		while ea < end:
+			cmd.ea = ea
+			ea += proc._ana()
+			count += 1
+		return count
+	sweep()
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		count = sweep()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	gc.collect()
+	blocks = allocated_blocks()
+	sweep()
+	gc.collect()
+	blocks = allocated_blocks() - blocks
+	return count, count / max(best, 1e-9), float(blocks) / max(count, 1)
+
 def PROCESSOR_ENTRY():
     return m65816_processor_t()	
 
@@ -0,0 +1,422 @@
+"""
+65816 instruction decoder, independent from IDA.
+
+Works on any buffer (str/bytes, bytearray, memoryview) plus the M/X/E
+processor state, and returns compact Instruction records. m65816.py is
+a thin IDA adapter over this module.
+"""
+
+import struct
+import sys
+import time
+from collections import namedtuple, OrderedDict
+
+# longest 65816 instruction: opcode + 24-bit operand
+MAX_INSN_SIZE	= 4
+
+# processor state, P register bit positions plus the hidden E flag
+FLAG_C		= 0x01
+FLAG_X		= 0x10
+FLAG_M		= 0x20
+FLAG_E		= 0x100
+# state after reset: emulation mode, 8-bit accumulator and index
+FLAGS_RESET	= FLAG_E | FLAG_M | FLAG_X
+
+U8		= struct.Struct("<B")
+U16		= struct.Struct("<H")
+U24		= struct.Struct("<HB")
+
+class DecodingError(Exception):
+	pass
+
+# addressing modes
+MODE_IMPLIED				= 0
+MODE_ACCUMULATOR			= 1
+MODE_STACK				= 2	# push / pull, register given by the opcode
+MODE_IMMEDIATE_M			= 3	# 8 or 16 bits depending on M
+MODE_IMMEDIATE_X			= 4	# 8 or 16 bits depending on X
+MODE_IMMEDIATE_8			= 5	# REP, SEP, BRK, COP, WDM
+MODE_DIRECT_PAGE			= 6	# d
+MODE_DP_INDEXED_X			= 7	# d,X
+MODE_DP_INDEXED_Y			= 8	# d,Y
+MODE_DP_INDIRECT			= 9	# (d)
+MODE_DP_INDEXED_INDIRECT_X		= 10	# (d,X)
+MODE_DP_INDIRECT_INDEXED_Y		= 11	# (d),Y
+MODE_DP_INDIRECT_LONG			= 12	# [d]
+MODE_DP_INDIRECT_LONG_INDEXED_Y		= 13	# [d],Y
+MODE_STACK_RELATIVE			= 14	# d,S
+MODE_STACK_RELATIVE_INDIRECT_INDEXED_Y	= 15	# (d,S),Y
+MODE_ABSOLUTE				= 16	# a
+MODE_ABSOLUTE_INDEXED_X			= 17	# a,X
+MODE_ABSOLUTE_INDEXED_Y			= 18	# a,Y
+MODE_ABSOLUTE_LONG			= 19	# al
+MODE_ABSOLUTE_LONG_INDEXED_X		= 20	# al,X
+MODE_ABSOLUTE_INDIRECT			= 21	# (a)
+MODE_ABSOLUTE_INDEXED_INDIRECT		= 22	# (a,X)
+MODE_ABSOLUTE_INDIRECT_LONG		= 23	# [a]
+MODE_RELATIVE				= 24	# 8-bit branch
+MODE_RELATIVE_LONG			= 25	# 16-bit branch
+MODE_BLOCK_MOVE				= 26	# MVN / MVP
+MODE_COUNT				= 27
+
+# operand size in bytes for each mode (immediates M/X are given for 8 bits)
+MODE_SIZES = (
+	0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+	1, 1, 2, 2, 2, 3, 3, 2, 2, 2, 1, 2, 2
+	)
+
+MNEMONICS = (
+	"adc", "and", "asl", "bcc", "bcs", "beq", "bit", "bmi", "bne", "bpl",
+	"bra", "brk", "brl", "bvc", "bvs", "clc", "cld", "cli", "clv", "cmp",
+	"cop", "cpx", "cpy", "dec", "dex", "dey", "eor", "inc", "inx", "iny",
+	"jml", "jmp", "jsl", "jsr", "lda", "ldx", "ldy", "lsr", "mvn", "mvp",
+	"nop", "ora", "pea", "pei", "per", "pha", "phb", "phd", "phk", "php",
+	"phx", "phy", "pla", "plb", "pld", "plp", "plx", "ply", "rep", "rol",
+	"ror", "rti", "rtl", "rts", "sbc", "sec", "sed", "sei", "sep", "sta",
+	"stp", "stx", "sty", "stz", "tax", "tay", "tcd", "tcs", "tdc", "trb",
+	"tsb", "tsc", "tsx", "txa", "txs", "txy", "tya", "tyx", "wai", "wdm",
+	"xba", "xce"
+	)
+
+# addressing mode of each (opcode & 0x1F) column for the ALU-style groups
+COLUMN_MODES = (
+	MODE_IMMEDIATE_X,			# 0x00
+	MODE_DP_INDEXED_INDIRECT_X,		# 0x01
+	MODE_IMMEDIATE_X,			# 0x02
+	MODE_STACK_RELATIVE,			# 0x03
+	MODE_DIRECT_PAGE,			# 0x04
+	MODE_DIRECT_PAGE,			# 0x05
+	MODE_DIRECT_PAGE,			# 0x06
+	MODE_DP_INDIRECT_LONG,			# 0x07
+	None,					# 0x08
+	MODE_IMMEDIATE_M,			# 0x09
+	MODE_ACCUMULATOR,			# 0x0A
+	None,					# 0x0B
+	MODE_ABSOLUTE,				# 0x0C
+	MODE_ABSOLUTE,				# 0x0D
+	MODE_ABSOLUTE,				# 0x0E
+	MODE_ABSOLUTE_LONG,			# 0x0F
+	None,					# 0x10
+	MODE_DP_INDIRECT_INDEXED_Y,		# 0x11
+	MODE_DP_INDIRECT,			# 0x12
+	MODE_STACK_RELATIVE_INDIRECT_INDEXED_Y,	# 0x13
+	MODE_DP_INDEXED_X,			# 0x14
+	MODE_DP_INDEXED_X,			# 0x15
+	MODE_DP_INDEXED_X,			# 0x16
+	MODE_DP_INDIRECT_LONG_INDEXED_Y,	# 0x17
+	None,					# 0x18
+	MODE_ABSOLUTE_INDEXED_Y,		# 0x19
+	MODE_ACCUMULATOR,			# 0x1A
+	None,					# 0x1B
+	MODE_ABSOLUTE_INDEXED_X,		# 0x1C
+	MODE_ABSOLUTE_INDEXED_X,		# 0x1D
+	MODE_ABSOLUTE_INDEXED_X,		# 0x1E
+	MODE_ABSOLUTE_LONG_INDEXED_X		# 0x1F
+	)
+
+# (mnemonic, mode, opcodes)
+# a mode of None means "given by COLUMN_MODES[opcode & 0x1F]"
+OPCODE_SPEC = [
+	("adc", None, [0x61, 0x63, 0x65, 0x67, 0x69, 0x6D, 0x6F, 0x71, 0x72, 0x73, 0x75, 0x77, 0x79, 0x7D, 0x7F]),
+	("and", None, [0x21, 0x23, 0x25, 0x27, 0x29, 0x2D, 0x2F, 0x31, 0x32, 0x33, 0x35, 0x37, 0x39, 0x3D, 0x3F]),
+	("asl", None, [0x06, 0x0A, 0x0E, 0x16, 0x1E]),
+	("bcc", MODE_RELATIVE, [0x90]),
+	("bcs", MODE_RELATIVE, [0xB0]),
+	("beq", MODE_RELATIVE, [0xF0]),
+	("bit", None, [0x24, 0x2C, 0x34, 0x3C, 0x89]),
+	("bmi", MODE_RELATIVE, [0x30]),
+	("bne", MODE_RELATIVE, [0xD0]),
+	("bpl", MODE_RELATIVE, [0x10]),
+	("bra", MODE_RELATIVE, [0x80]),
+	("brk", MODE_IMMEDIATE_8, [0x00]),
+	("brl", MODE_RELATIVE_LONG, [0x82]),
+	("bvc", MODE_RELATIVE, [0x50]),
+	("bvs", MODE_RELATIVE, [0x70]),
+	("clc", MODE_IMPLIED, [0x18]),
+	("cld", MODE_IMPLIED, [0xD8]),
+	("cli", MODE_IMPLIED, [0x58]),
+	("clv", MODE_IMPLIED, [0xB8]),
+	("cmp", None, [0xC1, 0xC3, 0xC5, 0xC7, 0xC9, 0xCD, 0xCF, 0xD1, 0xD2, 0xD3, 0xD5, 0xD7, 0xD9, 0xDD, 0xDF]),
+	("cop", MODE_IMMEDIATE_8, [0x02]),
+	("cpx", None, [0xE0, 0xE4, 0xEC]),
+	("cpy", None, [0xC0, 0xC4, 0xCC]),
+	("dec", None, [0x3A, 0xC6, 0xCE, 0xD6, 0xDE]),
+	("dex", MODE_IMPLIED, [0xCA]),
+	("dey", MODE_IMPLIED, [0x88]),
+	("eor", None, [0x41, 0x43, 0x45, 0x47, 0x49, 0x4D, 0x4F, 0x51, 0x52, 0x53, 0x55, 0x57, 0x59, 0x5D, 0x5F]),
+	("inc", None, [0x1A, 0xE6, 0xEE, 0xF6, 0xFE]),
+	("inx", MODE_IMPLIED, [0xE8]),
+	("iny", MODE_IMPLIED, [0xC8]),
+	("jml", MODE_ABSOLUTE_LONG, [0x5C]),
+	("jml", MODE_ABSOLUTE_INDIRECT_LONG, [0xDC]),
+	("jmp", MODE_ABSOLUTE, [0x4C]),
+	("jmp", MODE_ABSOLUTE_INDIRECT, [0x6C]),
+	("jmp", MODE_ABSOLUTE_INDEXED_INDIRECT, [0x7C]),
+	("jsl", MODE_ABSOLUTE_LONG, [0x22]),
+	("jsr", MODE_ABSOLUTE, [0x20]),
+	("jsr", MODE_ABSOLUTE_INDEXED_INDIRECT, [0xFC]),
+	("lda", None, [0xA1, 0xA3, 0xA5, 0xA7, 0xA9, 0xAD, 0xAF, 0xB1, 0xB2, 0xB3, 0xB5, 0xB7, 0xB9, 0xBD, 0xBF]),
+	("ldx", None, [0xA2, 0xA6, 0xAE]),
+	("ldx", MODE_DP_INDEXED_Y, [0xB6]),
+	("ldx", MODE_ABSOLUTE_INDEXED_Y, [0xBE]),
+	("ldy", None, [0xA0, 0xA4, 0xAC, 0xB4, 0xBC]),
+	("lsr", None, [0x46, 0x4A, 0x4E, 0x56, 0x5E]),
+	("mvn", MODE_BLOCK_MOVE, [0x54]),
+	("mvp", MODE_BLOCK_MOVE, [0x44]),
+	("nop", MODE_IMPLIED, [0xEA]),
+	("ora", None, [0x01, 0x03, 0x05, 0x07, 0x09, 0x0D, 0x0F, 0x11, 0x12, 0x13, 0x15, 0x17, 0x19, 0x1D, 0x1F]),
+	("pea", MODE_ABSOLUTE, [0xF4]),
+	("pei", MODE_DP_INDIRECT, [0xD4]),
+	("per", MODE_RELATIVE_LONG, [0x62]),
+	("pha", MODE_STACK, [0x48]),
+	("phb", MODE_STACK, [0x8B]),
+	("phd", MODE_STACK, [0x0B]),
+	("phk", MODE_STACK, [0x4B]),
+	("php", MODE_STACK, [0x08]),
+	("phx", MODE_STACK, [0xDA]),
+	("phy", MODE_STACK, [0x5A]),
+	("pla", MODE_STACK, [0x68]),
+	("plb", MODE_STACK, [0xAB]),
+	("pld", MODE_STACK, [0x2B]),
+	("plp", MODE_STACK, [0x28]),
+	("plx", MODE_STACK, [0xFA]),
+	("ply", MODE_STACK, [0x7A]),
+	("rep", MODE_IMMEDIATE_8, [0xC2]),
+	("rol", None, [0x26, 0x2A, 0x2E, 0x36, 0x3E]),
+	("ror", None, [0x66, 0x6A, 0x6E, 0x76, 0x7E]),
+	("rti", MODE_IMPLIED, [0x40]),
+	("rtl", MODE_IMPLIED, [0x6B]),
+	("rts", MODE_IMPLIED, [0x60]),
+	("sbc", None, [0xE1, 0xE3, 0xE5, 0xE7, 0xE9, 0xED, 0xEF, 0xF1, 0xF2, 0xF3, 0xF5, 0xF7, 0xF9, 0xFD, 0xFF]),
+	("sec", MODE_IMPLIED, [0x38]),
+	("sed", MODE_IMPLIED, [0xF8]),
+	("sei", MODE_IMPLIED, [0x78]),
+	("sep", MODE_IMMEDIATE_8, [0xE2]),
+	("sta", None, [0x81, 0x83, 0x85, 0x87, 0x8D, 0x8F, 0x91, 0x92, 0x93, 0x95, 0x97, 0x99, 0x9D, 0x9F]),
+	("stp", MODE_IMPLIED, [0xDB]),
+	("stx", None, [0x86, 0x8E]),
+	("stx", MODE_DP_INDEXED_Y, [0x96]),
+	("sty", None, [0x84, 0x8C, 0x94]),
+	("stz", None, [0x64, 0x74, 0x9E]),
+	("stz", MODE_ABSOLUTE, [0x9C]),
+	("tax", MODE_IMPLIED, [0xAA]),
+	("tay", MODE_IMPLIED, [0xA8]),
+	("tcd", MODE_IMPLIED, [0x5B]),
+	("tcs", MODE_IMPLIED, [0x1B]),
+	("tdc", MODE_IMPLIED, [0x7B]),
+	("trb", MODE_DIRECT_PAGE, [0x14]),
+	("trb", MODE_ABSOLUTE, [0x1C]),
+	("tsb", None, [0x04, 0x0C]),
+	("tsc", MODE_IMPLIED, [0x3B]),
+	("tsx", MODE_IMPLIED, [0xBA]),
+	("txa", MODE_IMPLIED, [0x8A]),
+	("txs", MODE_IMPLIED, [0x9A]),
+	("txy", MODE_IMPLIED, [0x9B]),
+	("tya", MODE_IMPLIED, [0x98]),
+	("tyx", MODE_IMPLIED, [0xBB]),
+	("wai", MODE_IMPLIED, [0xCB]),
+	("wdm", MODE_IMMEDIATE_8, [0x42]),
+	("xba", MODE_IMPLIED, [0xEB]),
+	("xce", MODE_IMPLIED, [0xFB])
+	]
+
+# a decoded instruction; mnemonic is an index into MNEMONICS, operand is
+# the raw little-endian operand (for MVN/MVP: first byte | second << 8)
+Instruction = namedtuple("Instruction", "address opcode mnemonic mode size operand")
+
+def build_opcode_table(spec):
+	mnemonics = dict((name, idx) for idx, name in enumerate(MNEMONICS))
+	table = [None] * 256
+	for name, mode, opcodes in spec:
+		for opcode in opcodes:
+			if mode is None:
+				table[opcode] = (mnemonics[name], COLUMN_MODES[opcode & 0x1F])
+			else:
+				table[opcode] = (mnemonics[name], mode)
+	if None in table:
+		raise ValueError("opcode %02X missing from spec" % table.index(None))
+	return table
+
+# opcode -> (mnemonic, mode)
+OPCODES = build_opcode_table(OPCODE_SPEC)
+
+def effective_flags(flags):
+	# emulation mode forces 8-bit accumulator and index registers
+	if flags & FLAG_E:
+		return flags | FLAG_M | FLAG_X
+	return flags
+
+def operand_size(mode, flags):
+	flags = effective_flags(flags)
+	if mode == MODE_IMMEDIATE_M and not flags & FLAG_M:
+		return 2
+	if mode == MODE_IMMEDIATE_X and not flags & FLAG_X:
+		return 2
+	return MODE_SIZES[mode]
+
+def state_index(flags):
+	# index of the (M, X) decode table for a processor state
+	return (effective_flags(flags) >> 4) & 3
+
+def length_table(flags):
+	"""
+	Instruction length of every opcode for a processor state, as a
+	256-byte bytearray usable with str.translate or a NumPy lookup.
+	"""
+	return bytearray(1 + operand_size(mode, flags) for mnemonic, mode in OPCODES)
+
+def _read_none(buf, offset):
+	return 0
+
+def _read_u8(buf, offset):
+	return U8.unpack_from(buf, offset)[0]
+
+def _read_u16(buf, offset):
+	return U16.unpack_from(buf, offset)[0]
+
+def _read_u24(buf, offset):
+	lo, hi = U24.unpack_from(buf, offset)
+	return lo | (hi << 16)
+
+OPERAND_READERS = (_read_none, _read_u8, _read_u16, _read_u24)
+
+def build_decode_tables():
+	# one 256-entry (mnemonic, mode, size, reader) table per (M, X) state
+	tables = [None] * 4
+	for index in range(4):
+		flags = index << 4
+		tables[index] = [(mnemonic, mode, 1 + operand_size(mode, flags), OPERAND_READERS[operand_size(mode, flags)])
+			for mnemonic, mode in OPCODES]
+	return tables
+
+DECODE_TABLES = build_decode_tables()
+
+def decode(buf, offset=0, address=0, flags=FLAGS_RESET):
+	"""
+	Decode the instruction at buf[offset], located at address.
+	Raises DecodingError if the buffer ends inside the instruction.
+	"""
+	if flags & FLAG_E:
+		table = DECODE_TABLES[3]
+	else:
+		table = DECODE_TABLES[(flags >> 4) & 3]
+	try:
+		opcode = U8.unpack_from(buf, offset)[0]
+		mnemonic, mode, size, reader = table[opcode]
+		operand = reader(buf, offset + 1)
+	except struct.error:
+		raise DecodingError()
+	return Instruction(address, opcode, mnemonic, mode, size, operand)
+
+class DecodeCache(object):
+	"""
+	Bounded LRU cache of decoded instructions, keyed by address,
+	instruction bytes and (M, X) decode state. A patch changes the key, so
+	stale entries can never be hit; invalidate() also drops them early.
+	"""
+
+	def __init__(self, size=4096):
+		self.size = size
+		self.entries = OrderedDict()
+		# address -> keys cached at that address
+		self.addresses = {}
+		self.hits = 0
+		self.misses = 0
+
+	def decode(self, buf, address, flags=FLAGS_RESET):
+		key = (address, state_index(flags), bytes(buf[:MAX_INSN_SIZE]))
+		entries = self.entries
+		insn = entries.pop(key, None)
+		if insn is not None:
+			self.hits += 1
+			entries[key] = insn
+			return insn
+		self.misses += 1
+		insn = decode(buf, 0, address, flags)
+		entries[key] = insn
+		self.addresses.setdefault(address, set()).add(key)
+		if len(entries) > self.size:
+			old = entries.popitem(last=False)[0]
+			self._forget(old)
+		return insn
+
+	def _forget(self, key):
+		keys = self.addresses.get(key[0])
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self.addresses[key[0]]
+
+	def invalidate(self, ea):
+		# drop every instruction that may cover the patched byte at ea
+		for address in range(ea - MAX_INSN_SIZE + 1, ea + 1):
+			for key in self.addresses.pop(address, ()):
+				del self.entries[key]
+
+	def clear(self):
+		self.entries.clear()
+		self.addresses.clear()
+
+	def stats(self):
+		total = self.hits + self.misses
+		return self.hits, self.misses, float(self.hits) / total if total else 0.0
+
+def disassemble(buf, address=0, flags=FLAGS_RESET, start=0, end=None):
+	"""
+	Linear sweep over buf[start:end], yielding Instruction records.
+	The processor state is not updated by REP/SEP along the way.
+	"""
+	if end is None:
+		end = len(buf)
+	offset = start
+	while offset < end:
+		try:
+			insn = decode(buf, offset, address + offset - start, flags)
+		except DecodingError:
+			return
+		yield insn
+		offset += insn.size
+
+def branch_target(insn):
+	"""
+	Destination of a relative branch, wrapped inside the current bank.
+	"""
+	if insn.mode == MODE_RELATIVE:
+		rel = insn.operand - 0x100 if insn.operand & 0x80 else insn.operand
+	elif insn.mode == MODE_RELATIVE_LONG:
+		rel = insn.operand - 0x10000 if insn.operand & 0x8000 else insn.operand
+	else:
+		return None
+	return (insn.address & 0xFF0000) | ((insn.address + insn.size + rel) & 0xFFFF)
+
+def bench(buf, flags=FLAGS_RESET, repeat=3):
+	"""
+	Linear-sweep decode throughput over buf, in instructions per second.
+	"""
+	best = None
+	count = 0
+	for i in range(repeat):
+		start = time.time()
+		count = 0
+		for insn in disassemble(buf, 0, flags):
+			count += 1
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return count, count / max(best, 1e-9)
+
+def main():
+	if len(sys.argv) < 2:
+		print("usage: %s <rom> [flags]" % sys.argv[0])
+		return 1
+	with open(sys.argv[1], "rb") as f:
+		buf = f.read()
+	flags = FLAGS_RESET
+	if len(sys.argv) > 2:
+		flags = int(sys.argv[2], 0)
+	count, rate = bench(buf, flags)
+	print("%d instructions, %.0f decodes/s" % (count, rate))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
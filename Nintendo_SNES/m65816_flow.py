@@ -0,0 +1,246 @@
+"""
+M/X/E processor state tracking for the 65816, independent from IDA.
+
+The width of immediates depends on the M and X flags, which are changed
+by REP, SEP, XCE and PLP. FlagTracker propagates that state along the
+control flow graph with a worklist: every instruction is decoded once
+per distinct entry state, and is only revisited when the state reaching
+it changes. The result is an IntervalMap of address ranges sharing the
+same state.
+
+A state is an int holding the flag values (FLAG_C/X/M/E, see
+m65816_decoder) in its low bits and, UNKNOWN_SHIFT bits higher, a mask
+of the flags whose value could not be determined. Unknown flags always
+have their value bit set, so they decode as 8-bit.
+"""
+
+from bisect import bisect_right
+from collections import deque
+
+from m65816_decoder import decode, branch_target, DecodingError, MNEMONICS, MAX_INSN_SIZE
+from m65816_decoder import FLAG_C, FLAG_X, FLAG_M, FLAG_E, FLAGS_RESET
+from m65816_decoder import MODE_ABSOLUTE, MODE_ABSOLUTE_LONG, MODE_RELATIVE, MODE_RELATIVE_LONG
+
+UNKNOWN_SHIFT	= 16
+FLAGS_MASK	= FLAG_C | FLAG_X | FLAG_M | FLAG_E
+
+REP		= MNEMONICS.index("rep")
+SEP		= MNEMONICS.index("sep")
+CLC		= MNEMONICS.index("clc")
+SEC		= MNEMONICS.index("sec")
+XCE		= MNEMONICS.index("xce")
+PHP		= MNEMONICS.index("php")
+PLP		= MNEMONICS.index("plp")
+JMP		= MNEMONICS.index("jmp")
+JML		= MNEMONICS.index("jml")
+JSR		= MNEMONICS.index("jsr")
+JSL		= MNEMONICS.index("jsl")
+PER		= MNEMONICS.index("per")
+
+# instructions after which execution does not fall through
+STOP_MNEMONICS = frozenset(MNEMONICS.index(name) for name in
+	("rts", "rtl", "rti", "bra", "brl", "jmp", "jml", "stp", "brk"))
+
+def merge_flags(a, b):
+	"""
+	Join two states: flags that differ, or are unknown in either, become
+	unknown.
+	"""
+	unknown = ((a >> UNKNOWN_SHIFT) | (b >> UNKNOWN_SHIFT) | (a ^ b)) & FLAGS_MASK
+	return ((a | b) & FLAGS_MASK) | (unknown << UNKNOWN_SHIFT)
+
+def _set(flags, bits, value):
+	# force bits to a known value
+	flags &= ~(bits << UNKNOWN_SHIFT)
+	if value:
+		return flags | bits
+	return flags & ~bits
+
+def _forget(flags, bits):
+	# mark bits unknown
+	return flags | bits | (bits << UNKNOWN_SHIFT)
+
+def next_flags(insn, flags, saved=None):
+	"""
+	State after executing insn. saved is the state pushed by the last
+	PHP seen on this path, if any, and is used to resolve PLP.
+	Returns (flags, saved).
+	"""
+	mnemonic = insn.mnemonic
+	if mnemonic == REP:
+		bits = insn.operand & FLAGS_MASK
+		if flags & FLAG_E:
+			# M/X stay 1 in emulation mode: when E itself is unknown, so
+			# is their value after REP
+			if (flags >> UNKNOWN_SHIFT) & FLAG_E:
+				flags = _forget(flags, bits & (FLAG_M | FLAG_X))
+			bits &= ~(FLAG_M | FLAG_X)
+		flags = _set(flags, bits, 0)
+	elif mnemonic == SEP:
+		flags = _set(flags, insn.operand & FLAGS_MASK, 1)
+	elif mnemonic == CLC:
+		flags = _set(flags, FLAG_C, 0)
+	elif mnemonic == SEC:
+		flags = _set(flags, FLAG_C, 1)
+	elif mnemonic == XCE:
+		carry = flags & FLAG_C
+		carry_unknown = (flags >> UNKNOWN_SHIFT) & FLAG_C
+		emulation = flags & FLAG_E
+		emulation_unknown = (flags >> UNKNOWN_SHIFT) & FLAG_E
+		flags = _set(flags, FLAG_C, emulation)
+		flags = _set(flags, FLAG_E, carry)
+		if emulation_unknown:
+			flags = _forget(flags, FLAG_C)
+		if carry_unknown:
+			flags = _forget(flags, FLAG_E)
+		if flags & FLAG_E and not carry_unknown:
+			flags = _set(flags, FLAG_M | FLAG_X, 1)
+	elif mnemonic == PHP:
+		saved = flags
+	elif mnemonic == PLP:
+		emulation = flags & (FLAG_E | (FLAG_E << UNKNOWN_SHIFT))
+		if saved is not None:
+			flags = (saved & ~(FLAG_E | (FLAG_E << UNKNOWN_SHIFT))) | emulation
+		else:
+			flags = _forget(flags, FLAG_C | FLAG_M | FLAG_X)
+		if flags & FLAG_E and not (flags >> UNKNOWN_SHIFT) & FLAG_E:
+			flags = _set(flags, FLAG_M | FLAG_X, 1)
+		saved = None
+	return flags, saved
+
+def next_address(address, size):
+	# the program counter wraps inside its bank
+	return (address & 0xFF0000) | ((address + size) & 0xFFFF)
+
+def flow_targets(insn):
+	"""
+	Statically known code destinations of insn, as a tuple of
+	(jumps, calls).
+	"""
+	mode = insn.mode
+	if mode == MODE_RELATIVE or mode == MODE_RELATIVE_LONG:
+		if insn.mnemonic == PER:
+			return (), ()
+		return (branch_target(insn),), ()
+	mnemonic = insn.mnemonic
+	if mode == MODE_ABSOLUTE:
+		target = (insn.address & 0xFF0000) | insn.operand
+		if mnemonic == JMP:
+			return (target,), ()
+		if mnemonic == JSR:
+			return (), (target,)
+	elif mode == MODE_ABSOLUTE_LONG:
+		if mnemonic == JML:
+			return (insn.operand,), ()
+		if mnemonic == JSL:
+			return (), (insn.operand,)
+	return (), ()
+
+class IntervalMap(object):
+	"""
+	Sorted, non-overlapping [start, end) ranges each carrying a value.
+	"""
+
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+		self.values = []
+
+	def append(self, start, end, value):
+		# ranges must be appended in increasing address order
+		if self.starts and self.ends[-1] == start and self.values[-1] == value:
+			self.ends[-1] = end
+			return
+		self.starts.append(start)
+		self.ends.append(end)
+		self.values.append(value)
+
+	def lookup(self, address, default=None):
+		i = bisect_right(self.starts, address) - 1
+		if i >= 0 and address < self.ends[i]:
+			return self.values[i]
+		return default
+
+	def __iter__(self):
+		return iter(zip(self.starts, self.ends, self.values))
+
+	def __len__(self):
+		return len(self.starts)
+
+def buffer_reader(buf, base=0):
+	"""
+	read(address) callable over a flat buffer mapped at base.
+	"""
+	view = memoryview(buf)
+	size = len(buf)
+	def read(address):
+		offset = address - base
+		if offset < 0 or offset >= size:
+			return None
+		return view[offset:offset + MAX_INSN_SIZE]
+	return read
+
+class FlagTracker(object):
+	"""
+	Worklist propagation of the processor state from a set of entry
+	points. read(address) must return the instruction bytes at address
+	(up to MAX_INSN_SIZE of them) or None outside of mapped memory.
+	"""
+
+	def __init__(self, read):
+		self.read = read
+		# instruction address -> entry state / instruction size
+		self.states = {}
+		self.sizes = {}
+		self.worklist = deque()
+		self.decoded = 0
+
+	def add_entry(self, address, flags=FLAGS_RESET):
+		self.worklist.append((address, flags))
+
+	def run(self):
+		worklist = self.worklist
+		while worklist:
+			address, flags = worklist.popleft()
+			self._run_block(address, flags)
+		return self
+
+	def _run_block(self, address, flags):
+		states = self.states
+		saved = None
+		while True:
+			old = states.get(address)
+			if old is not None:
+				flags = merge_flags(old, flags)
+				if flags == old:
+					return
+			window = self.read(address)
+			if window is None:
+				return
+			try:
+				insn = decode(window, 0, address, flags)
+			except DecodingError:
+				return
+			states[address] = flags
+			self.sizes[address] = insn.size
+			self.decoded += 1
+			jumps, calls = flow_targets(insn)
+			for target in jumps:
+				self.worklist.append((target, flags))
+			for target in calls:
+				self.worklist.append((target, flags))
+			flags, saved = next_flags(insn, flags, saved)
+			if insn.mnemonic in STOP_MNEMONICS:
+				return
+			address = next_address(address, insn.size)
+
+	def intervals(self):
+		"""
+		IntervalMap of the decoded instructions, coalescing neighbours
+		that share the same state.
+		"""
+		result = IntervalMap()
+		sizes = self.sizes
+		for address in sorted(self.states):
+			result.append(address, address + sizes[address], self.states[address])
+		return result
@@ -0,0 +1,118 @@
+"""
+Linear-sweep instruction boundary pre-pass for 65816 ROMs.
+
+For fast triage of code vs data banks: instruction lengths for a whole
+bank are looked up at once from the 256-entry length_table() of the
+(M, X) state, then a tight loop walks the precomputed lengths to mark
+instruction starts. The output of each bank is a per-byte start mask and
+an opcode histogram.
+
+NumPy is used when available; otherwise bytes.translate does the
+lookup, with the same results.
+"""
+
+import sys
+
+from m65816_decoder import length_table, state_index, FLAGS_RESET
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+LOROM_BANK_SIZE	= 0x8000
+HIROM_BANK_SIZE	= 0x10000
+
+# one length table per (M, X) state, indexed by state_index()
+LENGTH_TABLES = [length_table(index << 4) for index in range(4)]
+
+# opcodes rarely met in real code: BRK, COP, WDM, STP, and SBC al,X
+# which is what runs of 0xFF padding decode to
+UNLIKELY_OPCODES = (0x00, 0x02, 0x42, 0xDB, 0xFF)
+
+def instruction_lengths(buf, flags=FLAGS_RESET):
+	"""
+	Length of the instruction starting at every byte of buf, as a
+	bytearray.
+	"""
+	table = LENGTH_TABLES[state_index(flags)]
+	if numpy is not None:
+		lut = numpy.frombuffer(bytes(table), dtype=numpy.uint8)
+		return bytearray(lut[numpy.frombuffer(bytes(buf), dtype=numpy.uint8)].tobytes())
+	return bytearray(bytes(buf).translate(bytes(table)))
+
+def walk(lengths, start=0):
+	"""
+	Instruction start mask (one byte per input byte, 1 = start) of a
+	linear sweep from start.
+	"""
+	size = len(lengths)
+	mask = bytearray(size)
+	offset = start
+	while offset < size:
+		mask[offset] = 1
+		offset += lengths[offset]
+	return mask
+
+def histogram(buf, mask):
+	# opcode counts over the instruction starts
+	if numpy is not None:
+		data = numpy.frombuffer(bytes(buf), dtype=numpy.uint8)
+		starts = numpy.frombuffer(bytes(mask), dtype=numpy.uint8).astype(bool)
+		return [int(n) for n in numpy.bincount(data[starts], minlength=256)]
+	counts = [0] * 256
+	for opcode, start in zip(bytearray(buf), mask):
+		if start:
+			counts[opcode] += 1
+	return counts
+
+def code_score(counts):
+	"""
+	Rough code likelihood of a bank in [0, 1]: the share of decoded
+	instructions that are not in UNLIKELY_OPCODES.
+	"""
+	total = sum(counts)
+	if total == 0:
+		return 0.0
+	unlikely = sum(counts[opcode] for opcode in UNLIKELY_OPCODES)
+	return 1.0 - float(unlikely) / total
+
+def sweep_bank(buf, flags=FLAGS_RESET):
+	"""
+	Returns (start mask, opcode histogram) of one bank.
+	"""
+	mask = walk(instruction_lengths(buf, flags))
+	return mask, histogram(buf, mask)
+
+def sweep(rom, bank_size=LOROM_BANK_SIZE, flags=FLAGS_RESET):
+	"""
+	Yields (bank index, start mask, opcode histogram) for every bank.
+	The lookup runs once over the whole ROM; the walk restarts at each
+	bank boundary.
+	"""
+	lengths = instruction_lengths(rom, flags)
+	for index, start in enumerate(range(0, len(rom), bank_size)):
+		bank = rom[start:start + bank_size]
+		mask = walk(lengths[start:start + bank_size])
+		yield index, mask, histogram(bank, mask)
+
+def main():
+	if len(sys.argv) < 2:
+		print("usage: %s <rom> [bank size] [flags]" % sys.argv[0])
+		return 1
+	with open(sys.argv[1], "rb") as f:
+		rom = bytearray(f.read())
+	if len(rom) % 0x400 == 0x200:
+		rom = rom[0x200:]
+	bank_size = LOROM_BANK_SIZE
+	if len(sys.argv) > 2:
+		bank_size = int(sys.argv[2], 0)
+	flags = FLAGS_RESET
+	if len(sys.argv) > 3:
+		flags = int(sys.argv[3], 0)
+	for index, mask, counts in sweep(rom, bank_size, flags):
+		print("bank %02X: %6d instructions, code score %.2f" % (index, sum(counts), code_score(counts)))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
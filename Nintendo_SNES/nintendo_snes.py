@@ -0,0 +1,172 @@
+import idc
+import idaapi
+import os
+import struct
+import sys
+
+LOADER_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(LOADER_DIR)
+sys.path.append(os.path.join(LOADER_DIR, "..", "IO_registers"))
+from io_naming import apply_names
+from snes_header import copier_header_size, best_header as find_header, HEADER_SIZE, MIN_SCORE
+from snes_header import LOROM, HIROM, MAPPING_NAMES
+
+ROM_FORMAT_NAME		= "Nintendo SNES ROM"
+
+BANK_SIZE		= 0x10000
+WRAM_START		= 0x7E0000
+WRAM_SIZE		= 0x20000
+PPU_IO_START		= 0x2100
+PPU_IO_SIZE		= 0x100
+CPU_IO_START		= 0x4000
+CPU_IO_SIZE		= 0x400
+
+# (name, offset in the header) of the interrupt vectors
+VECTORS = [
+	("native_cop", 0x24),
+	("native_brk", 0x26),
+	("native_abort", 0x28),
+	("native_nmi", 0x2A),
+	("native_irq", 0x2E),
+	("emu_cop", 0x34),
+	("emu_abort", 0x38),
+	("emu_nmi", 0x3A),
+	("reset", 0x3C),
+	("emu_irq", 0x3E)
+	]
+
+def best_header(li):
+	"""
+	Returns (score, mapping, header file offset) of the most plausible
+	internal header, see snes_header.best_header.
+	"""
+	li.seek(0, idaapi.SEEK_END)
+	size = li.tell()
+	def read(offset, length):
+		li.seek(offset)
+		return li.read(length)
+	return find_header(read, size)
+
+def rom_banks(mapping, size):
+	"""
+	(address, file offset, length) of every ROM chunk and mirror, for
+	a ROM of size bytes (without copier header).
+	"""
+	chunks = []
+	if mapping == LOROM:
+		# 32 KiB banks at $8000-$FFFF of banks $00-$7D, mirrored at $80-$FF
+		for i in xrange(0, min(size >> 15, 0x7E)):
+			chunks.append(((i << 16) | 0x8000, i << 15, 0x8000))
+		for i in xrange(0, min(size >> 15, 0x80)):
+			chunks.append((((0x80 + i) << 16) | 0x8000, i << 15, 0x8000))
+	elif mapping == HIROM:
+		# 64 KiB banks at $C0-$FF, mirrored at $40-$7D, upper halves at $00-$3F / $80-$BF
+		for i in xrange(0, min(size >> 16, 0x40)):
+			chunks.append(((0xC0 + i) << 16, i << 16, BANK_SIZE))
+			if i < 0x3E:
+				chunks.append(((0x40 + i) << 16, i << 16, BANK_SIZE))
+			chunks.append(((i << 16) | 0x8000, (i << 16) | 0x8000, 0x8000))
+			chunks.append((((0x80 + i) << 16) | 0x8000, (i << 16) | 0x8000, 0x8000))
+	else:
+		# first 4 MiB at $C0-$FF (upper halves at $80-$BF), the rest at
+		# $40-$7D (upper halves at $00-$3D)
+		for i in xrange(0, min(size >> 16, 0x40)):
+			chunks.append(((0xC0 + i) << 16, i << 16, BANK_SIZE))
+			chunks.append((((0x80 + i) << 16) | 0x8000, (i << 16) | 0x8000, 0x8000))
+		for i in xrange(0, min((size >> 16) - 0x40, 0x3E)):
+			chunks.append(((0x40 + i) << 16, (0x40 + i) << 16, BANK_SIZE))
+			chunks.append((((i) << 16) | 0x8000, ((0x40 + i) << 16) | 0x8000, 0x8000))
+	return chunks
+
+def add_bank_seg(start, end, name, sclass):
+	# 65816 segments are based on their bank, so offsets stay 16-bit
+	idc.AddSeg(start, end, (start & 0xFF0000) >> 4, 0, idaapi.saRelPara, idaapi.scPub)
+	idc.RenameSeg(start, name)
+	idc.SetSegClass(start, sclass)
+
+def accept_file(li, n):
+	# we support only one format per file
+	if n > 0:
+		return 0
+
+	score, mapping, offset = best_header(li)
+	if score >= MIN_SCORE:
+		return "%s (%s)" % (ROM_FORMAT_NAME, MAPPING_NAMES[mapping])
+
+	# unrecognized format
+	return 0
+
+def load_file(li, neflags, format):
+	if not format.startswith(ROM_FORMAT_NAME):
+		Warning("Unknown format name: '%s'" % format)
+		return 0
+	idaapi.set_processor_type("65816", SETPROC_ALL|SETPROC_FATAL)
+	li.seek(0, idaapi.SEEK_END)
+	size = li.tell()
+	base = copier_header_size(size)
+	score, mapping, header = best_header(li)
+
+	# ROM banks and mirrors, one file2base per chunk
+	for ea, offset, length in rom_banks(mapping, size - base):
+		add_bank_seg(ea, ea + length, "ROM%02X" % (ea >> 16), "CODE")
+		idc.SetSegmentType(ea, idc.SEG_CODE)
+		li.file2base(base + offset, ea, ea + length, 0)
+
+	# WRAM
+	add_bank_seg(WRAM_START, WRAM_START + 0x10000, "WRAM7E", "DATA")
+	add_bank_seg(WRAM_START + 0x10000, WRAM_START + WRAM_SIZE, "WRAM7F", "DATA")
+
+	# PPU / CPU registers
+	add_bank_seg(PPU_IO_START, PPU_IO_START + PPU_IO_SIZE, "PPU", "IO")
+	add_bank_seg(CPU_IO_START, CPU_IO_START + CPU_IO_SIZE, "CPU", "IO")
+
+	li.seek(header)
+	header_info(li.read(HEADER_SIZE), mapping)
+	vectors(li, header)
+	apply_names("snes")
+	print("[+] Load OK")
+	return 1
+
+def vectors(li, header):
+	li.seek(header)
+	buf = li.read(HEADER_SIZE)
+	for name, off in VECTORS:
+		target, = struct.unpack_from("<H", buf, off)
+		ea = 0xFFC0 + off
+		idc.MakeWord(ea)
+		idc.MakeNameEx(ea, "vec_" + name, idc.SN_NOCHECK | idc.SN_NOWARN)
+		if target < 0x8000 or target == 0xFFFF:
+			continue
+		# interrupts in native mode keep the M/X of the interrupted code,
+		# reset and the emulation vectors run with E=M=X=1
+		if name.startswith("native_"):
+			idc.SetRegEx(target, "EF", 0, idc.SR_user)
+		else:
+			for reg in ("EF", "MF", "XF"):
+				idc.SetRegEx(target, reg, 1, idc.SR_user)
+		idaapi.add_entry(target, target, name, 1)
+		if name == "reset":
+			idaapi.cvar.inf.startIP = target
+			idaapi.cvar.inf.beginEA = target
+
+def header_info(buf, mapping):
+	title = struct.unpack_from("<21s", buf, 0)[0]
+	mode, romtype, romsize, sramsize, country, license, version = struct.unpack_from("<7B", buf, 0x15)
+	complement, checksum = struct.unpack_from("<HH", buf, 0x1C)
+	ea = 0xFFC0
+	idaapi.add_long_cmt(ea, True, "-------------------------------")
+	idc.ExtLinA(ea, 1,  "; ROM HEADER (%s)" % MAPPING_NAMES[mapping])
+	idc.ExtLinA(ea, 2,  "; TITLE : %s" % title)
+	idc.ExtLinA(ea, 3,  "; Map Mode : %02X" % mode)
+	idc.ExtLinA(ea, 4,  "; Cartridge Type : %02X" % romtype)
+	idc.ExtLinA(ea, 5,  "; ROM Size : %02X" % romsize)
+	idc.ExtLinA(ea, 6,  "; SRAM Size : %02X" % sramsize)
+	idc.ExtLinA(ea, 7,  "; Country : %02X" % country)
+	idc.ExtLinA(ea, 8,  "; License Code : %02X" % license)
+	idc.ExtLinA(ea, 9,  "; Version : %02X" % version)
+	idc.ExtLinA(ea, 10,  "; Checksum Complement : %04X" % complement)
+	idc.ExtLinA(ea, 11,  "; Checksum : %04X" % checksum)
+	idc.ExtLinA(ea, 12,  "-------------------------------")
+
+def main():
+	return 0
@@ -0,0 +1,239 @@
+"""
+Headless recursive-descent disassembler for SNES ROMs.
+
+Starts from the native and emulation mode vectors, follows branches,
+JMP/JML and JSR/JSL with the M/X/E state tracked by m65816_flow, and
+writes a code/data map plus the call graph of each ROM to JSON.
+
+usage: python snes_disasm.py [-o outdir] rom.sfc [rom.sfc ...]
+"""
+
+import argparse
+import json
+import os
+import re
+import struct
+import sys
+import time
+from collections import deque
+
+from m65816_decoder import decode, DecodingError, MAX_INSN_SIZE, FLAGS_RESET, FLAG_E, FLAG_M, FLAG_X, FLAG_C
+from m65816_flow import merge_flags, next_flags, next_address, flow_targets, STOP_MNEMONICS, UNKNOWN_SHIFT
+from snes_header import best_header, copier_header_size, HEADER_OFFSETS, LOROM, EXHIROM, MAPPING_NAMES
+
+# -m option values
+MAPPING_OPTIONS		= dict((name.lower(), mapping) for mapping, name in enumerate(MAPPING_NAMES))
+
+# (name, vector address, initial state); interrupts taken in native mode
+# keep the M/X of the interrupted code, so they start unknown
+VECTORS = [
+	("native_cop", 0xFFE4, (FLAG_M | FLAG_X) << UNKNOWN_SHIFT | FLAG_M | FLAG_X),
+	("native_brk", 0xFFE6, (FLAG_M | FLAG_X) << UNKNOWN_SHIFT | FLAG_M | FLAG_X),
+	("native_abort", 0xFFE8, (FLAG_M | FLAG_X) << UNKNOWN_SHIFT | FLAG_M | FLAG_X),
+	("native_nmi", 0xFFEA, (FLAG_M | FLAG_X) << UNKNOWN_SHIFT | FLAG_M | FLAG_X),
+	("native_irq", 0xFFEE, (FLAG_M | FLAG_X) << UNKNOWN_SHIFT | FLAG_M | FLAG_X),
+	("emu_cop", 0xFFF4, FLAGS_RESET),
+	("emu_abort", 0xFFF8, FLAGS_RESET),
+	("emu_nmi", 0xFFFA, FLAGS_RESET),
+	("reset", 0xFFFC, FLAGS_RESET),
+	("emu_irq", 0xFFFE, FLAGS_RESET)
+	]
+
+# code map values
+CODE_NONE		= 0
+CODE_START		= 1
+CODE_BODY		= 2
+CODE_RUN		= re.compile(b"[\x01\x02]+")
+
+def strip_copier_header(rom):
+	return rom[copier_header_size(len(rom)):]
+
+def detect_mapping(rom):
+	score, mapping, offset = best_header(lambda offset, length: rom[offset:offset + length], len(rom))
+	return mapping
+
+def rom_offset(address, mapping, size):
+	"""
+	File offset of a SNES address, or None if it is not ROM.
+	"""
+	bank = address >> 16
+	addr = address & 0xFFFF
+	if bank in (0x7E, 0x7F):
+		# WRAM banks
+		return None
+	if mapping == LOROM:
+		if not addr & 0x8000:
+			return None
+		offset = ((bank & 0x7F) << 15) | (addr & 0x7FFF)
+	else:
+		if not (bank & 0x40 or addr & 0x8000):
+			return None
+		offset = ((bank & 0x3F) << 16) | addr
+		if mapping == EXHIROM and not bank & 0x80:
+			# banks $00-$7D hold the second 4 MiB
+			offset |= 0x400000
+	if offset >= size:
+		# smaller ROMs are mirrored through the address space
+		offset %= size
+	return offset
+
+def rom_address(offset, mapping):
+	"""
+	Canonical SNES address of a file offset.
+	"""
+	if mapping == LOROM:
+		return ((offset >> 15) << 16) | 0x8000 | (offset & 0x7FFF)
+	if mapping == EXHIROM and offset >= 0x400000:
+		return offset
+	return 0xC00000 | offset
+
+def pack_state(flags):
+	# fit a state in one byte: C/X/M/E values, then C/X/M/E unknown bits
+	packed = 0
+	for i, bit in enumerate((FLAG_C, FLAG_X, FLAG_M, FLAG_E)):
+		if flags & bit:
+			packed |= 1 << i
+		if (flags >> UNKNOWN_SHIFT) & bit:
+			packed |= 0x10 << i
+	return packed
+
+def unpack_state(packed):
+	flags = 0
+	for i, bit in enumerate((FLAG_C, FLAG_X, FLAG_M, FLAG_E)):
+		if packed & (1 << i):
+			flags |= bit
+		if packed & (0x10 << i):
+			flags |= bit << UNKNOWN_SHIFT
+	return flags
+
+class Disassembler(object):
+	"""
+	Recursive descent over a ROM image. code and states are bytearrays
+	indexed by file offset: code holds CODE_START / CODE_BODY, states the
+	packed entry state of each instruction start.
+	"""
+
+	def __init__(self, rom, mapping=None):
+		self.rom = rom
+		self.view = memoryview(rom)
+		self.size = len(rom)
+		self.mapping = detect_mapping(rom) if mapping is None else mapping
+		self.code = bytearray(self.size)
+		self.states = bytearray(self.size)
+		self.worklist = deque()
+		self.entries = {}
+		# function address -> set of callee addresses
+		self.calls = {}
+		self.decoded = 0
+
+	def vector(self, address):
+		offset = HEADER_OFFSETS[self.mapping] + (address - 0xFFC0)
+		if offset + 2 > self.size:
+			return None
+		return struct.unpack_from("<H", self.rom, offset)[0]
+
+	def add_vectors(self):
+		for name, address, flags in VECTORS:
+			target = self.vector(address)
+			if target is None or target < 0x8000 or target == 0xFFFF:
+				continue
+			self.add_entry(target, flags, name)
+
+	def add_entry(self, address, flags=FLAGS_RESET, name=None):
+		if name is not None:
+			self.entries[address] = name
+		self.calls.setdefault(address, set())
+		self.worklist.append((address, flags, address))
+
+	def run(self):
+		worklist = self.worklist
+		while worklist:
+			address, flags, function = worklist.popleft()
+			self._run_block(address, flags, function)
+		return self
+
+	def _run_block(self, address, flags, function):
+		code = self.code
+		states = self.states
+		saved = None
+		while True:
+			offset = rom_offset(address, self.mapping, self.size)
+			if offset is None:
+				return
+			if code[offset] == CODE_START:
+				old = unpack_state(states[offset])
+				flags = merge_flags(old, flags)
+				if flags == old:
+					return
+			try:
+				insn = decode(self.view[offset:offset + MAX_INSN_SIZE], 0, address, flags)
+			except DecodingError:
+				return
+			code[offset] = CODE_START
+			states[offset] = pack_state(flags)
+			for i in range(offset + 1, min(offset + insn.size, self.size)):
+				if code[i] == CODE_NONE:
+					code[i] = CODE_BODY
+			self.decoded += 1
+			jumps, calls = flow_targets(insn)
+			for target in jumps:
+				self.worklist.append((target, flags, function))
+			for target in calls:
+				self.calls[function].add(target)
+				if target not in self.calls:
+					self.calls[target] = set()
+				self.worklist.append((target, flags, target))
+			flags, saved = next_flags(insn, flags, saved)
+			if insn.mnemonic in STOP_MNEMONICS:
+				return
+			address = next_address(address, insn.size)
+
+	def code_ranges(self):
+		"""
+		[start, end) file offset ranges covered by decoded instructions.
+		"""
+		return [match.span() for match in CODE_RUN.finditer(bytes(self.code))]
+
+	def report(self):
+		code_bytes = self.size - self.code.count(bytearray((CODE_NONE,)))
+		return {
+			"mapping": MAPPING_NAMES[self.mapping].lower(),
+			"size": self.size,
+			"instructions": self.code.count(bytearray((CODE_START,))),
+			"code_bytes": code_bytes,
+			"data_bytes": self.size - code_bytes,
+			"entries": dict(("%06X" % address, name) for address, name in self.entries.items()),
+			"code": self.code_ranges(),
+			"call_graph": dict(("%06X" % caller, sorted("%06X" % callee for callee in callees))
+				for caller, callees in self.calls.items())
+			}
+
+def disassemble_file(path, mapping=None):
+	with open(path, "rb") as f:
+		rom = strip_copier_header(bytearray(f.read()))
+	disasm = Disassembler(rom, mapping)
+	disasm.add_vectors()
+	return disasm.run()
+
+def main():
+	parser = argparse.ArgumentParser(description="Recursive-descent SNES disassembler")
+	parser.add_argument("roms", nargs="+")
+	parser.add_argument("-o", "--outdir", default=None, help="directory of the JSON reports (default: next to each ROM)")
+	parser.add_argument("-m", "--mapping", choices=sorted(MAPPING_OPTIONS), default=None)
+	args = parser.parse_args()
+	for path in args.roms:
+		start = time.time()
+		disasm = disassemble_file(path, MAPPING_OPTIONS.get(args.mapping))
+		report = disasm.report()
+		report["rom"] = os.path.basename(path)
+		out = os.path.splitext(path)[0] + ".json"
+		if args.outdir is not None:
+			out = os.path.join(args.outdir, os.path.basename(out))
+		with open(out, "w") as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+		print("[+] %s: %s, %d instructions, %d code bytes, %.2fs" % (path, report["mapping"],
+			report["instructions"], report["code_bytes"], time.time() - start))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
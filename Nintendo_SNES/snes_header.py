@@ -0,0 +1,80 @@
+"""
+SNES internal header detection, independent from IDA.
+
+Shared by the nintendo_snes loader and snes_disasm: the header candidates
+of every mapping (LoROM, HiROM, ExHiROM) are scored on the checksum /
+complement pair, the map mode byte, the reset vector and a few sanity
+checks on the other header fields, and the best one gives the mapping.
+"""
+
+import struct
+
+COPIER_HEADER_SIZE	= 0x200
+HEADER_SIZE		= 0x40
+# minimal header score for a file to be accepted
+MIN_SCORE		= 8
+
+LOROM			= 0
+HIROM			= 1
+EXHIROM			= 2
+MAPPING_NAMES		= ["LoROM", "HiROM", "ExHiROM"]
+
+# internal header file offsets, without copier header
+LOROM_HEADER		= 0x7FC0
+HIROM_HEADER		= 0xFFC0
+EXHIROM_HEADER		= 0x40FFC0
+HEADER_OFFSETS		= [LOROM_HEADER, HIROM_HEADER, EXHIROM_HEADER]
+
+# map mode byte (header + 0x15), ignoring the FastROM bit 0x10
+MAP_MODES		= [0x20, 0x21, 0x25]
+
+def copier_header_size(size):
+	if size % 0x400 == COPIER_HEADER_SIZE:
+		return COPIER_HEADER_SIZE
+	return 0
+
+def isprint(c):
+	return c >= 0x20 and c <= 0x7E
+
+def score_header(buf, off, mapping):
+	"""
+	Plausibility of an internal header at buf[off:off + HEADER_SIZE].
+	"""
+	if off + HEADER_SIZE > len(buf):
+		return 0
+	score = 0
+	title = struct.unpack_from("<21B", buf, off)
+	mode, romtype, romsize, sramsize = struct.unpack_from("<4B", buf, off + 0x15)
+	complement, checksum = struct.unpack_from("<HH", buf, off + 0x1C)
+	reset, = struct.unpack_from("<H", buf, off + 0x3C)
+	if complement ^ checksum == 0xFFFF:
+		score += 8
+	if mode & 0xEF == MAP_MODES[mapping]:
+		score += 4
+	if reset >= 0x8000 and reset != 0xFFFF:
+		score += 2
+	if romsize >= 0x07 and romsize <= 0x0D:
+		score += 1
+	if sramsize <= 0x08:
+		score += 1
+	if all(isprint(c) for c in title):
+		score += 1
+	return score
+
+def best_header(read, size):
+	"""
+	Returns (score, mapping, header file offset) of the most plausible
+	internal header of a file of size bytes, read(offset, length) giving
+	its contents. LoROM and HiROM are scored from one bulk read, and
+	ExHiROM from a second fixed-size read, whatever the ROM size.
+	"""
+	base = copier_header_size(size)
+	window = read(base + LOROM_HEADER, HIROM_HEADER + HEADER_SIZE - LOROM_HEADER)
+	candidates = [
+		(score_header(window, 0, LOROM), LOROM, base + LOROM_HEADER),
+		(score_header(window, HIROM_HEADER - LOROM_HEADER, HIROM), HIROM, base + HIROM_HEADER)
+		]
+	if size >= base + EXHIROM_HEADER + HEADER_SIZE:
+		candidates.append((score_header(read(base + EXHIROM_HEADER, HEADER_SIZE), 0, EXHIROM), EXHIROM,
+			base + EXHIROM_HEADER))
+	return max(candidates)